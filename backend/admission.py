@@ -0,0 +1,191 @@
+"""Admission control: per-class concurrency limits for API routes.
+
+Every route belongs to a class, set with @route_class below @app.route:
+
+    interactive  login, reports, test entry and anything not marked
+    background   exports, imports, bulk registration, sync and dashboard stats
+    admin        maintenance endpoints
+
+Each class runs at most ADMISSION_<CLASS>_LIMIT requests at once, and up to
+ADMISSION_<CLASS>_QUEUE more wait for a slot, for at most
+ADMISSION_QUEUE_TIMEOUT_SECONDS. A request that finds the queue full or times
+out gets a 503 with Retry-After instead of tying up a worker. Since the app
+opens one database connection per request, the limits also cap how many
+connections each class holds, so a burst of exports can't take the
+connections report printing needs.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from flask import current_app, g, jsonify, request
+
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv('ADMISSION_QUEUE_TIMEOUT_SECONDS', '5'))
+DEFAULT_CLASS = 'interactive'
+# class -> (default concurrency limit, default queue depth)
+CLASS_DEFAULTS = {
+    'interactive': (32, 64),
+    'background': (4, 8),
+    'admin': (2, 4),
+}
+# Recent queue waits and service times kept per class for metrics and Retry-After
+SAMPLE_SIZE = 500
+MAX_RETRY_AFTER_SECONDS = 120
+
+
+class Saturated(Exception):
+    def __init__(self, class_name, retry_after):
+        super().__init__(f'Server is busy with {class_name} requests, retry in {retry_after}s')
+        self.class_name = class_name
+        self.retry_after = retry_after
+
+
+class Ticket:
+    __slots__ = ('admission_class', 'admitted_at', 'released')
+
+    def __init__(self, admission_class):
+        self.admission_class = admission_class
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        # Called from both response close and request teardown; only the first counts
+        if self.released:
+            return
+        self.released = True
+        self.admission_class.release(time.monotonic() - self.admitted_at)
+
+
+class AdmissionClass:
+    def __init__(self, name, limit, queue_depth):
+        self.name = name
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._counts = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timedOut': 0}
+        self._waits = deque(maxlen=SAMPLE_SIZE)
+        self._service_times = deque(maxlen=SAMPLE_SIZE)
+
+    def retry_after(self):
+        """Seconds until a slot is likely free, from recent service times; call with the lock held."""
+        if not self._service_times:
+            return 1
+        mean = sum(self._service_times) / len(self._service_times)
+        return max(1, min(MAX_RETRY_AFTER_SECONDS, math.ceil(mean * (self._waiting + 1) / self.limit)))
+
+    def acquire(self, timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS):
+        """Take a slot, waiting in the queue if need be; raises Saturated."""
+        started = time.monotonic()
+        with self._cond:
+            if self._active >= self.limit:
+                if self._waiting >= self.queue_depth:
+                    self._counts['rejected'] += 1
+                    raise Saturated(self.name, self.retry_after())
+                self._waiting += 1
+                self._counts['queued'] += 1
+                try:
+                    deadline = started + timeout
+                    while self._active >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._counts['timedOut'] += 1
+                            raise Saturated(self.name, self.retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self._counts['admitted'] += 1
+            self._waits.append(time.monotonic() - started)
+        return Ticket(self)
+
+    def release(self, service_time):
+        with self._cond:
+            self._active -= 1
+            self._service_times.append(service_time)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                'limit': self.limit,
+                'queueDepth': self.queue_depth,
+                'active': self._active,
+                'waiting': self._waiting,
+                **self._counts,
+                'queueWaitMs': {
+                    'avg': round(1000 * sum(waits) / len(waits), 2) if waits else 0,
+                    'p95': round(1000 * waits[int(0.95 * (len(waits) - 1))], 2) if waits else 0,
+                    'max': round(1000 * waits[-1], 2) if waits else 0,
+                },
+            }
+
+
+def _class_from_env(name, limit, queue_depth):
+    prefix = f'ADMISSION_{name.upper()}'
+    return AdmissionClass(
+        name,
+        max(1, int(os.getenv(f'{prefix}_LIMIT', limit))),
+        max(0, int(os.getenv(f'{prefix}_QUEUE', queue_depth))),
+    )
+
+
+classes = {name: _class_from_env(name, *defaults) for name, defaults in CLASS_DEFAULTS.items()}
+
+
+def route_class(name):
+    """Put a view in an admission class; None exempts it (e.g. long-lived event streams)."""
+    if name is not None and name not in classes:
+        raise ValueError(f'Unknown admission class: {name}')
+
+    def decorator(f):
+        f.admission_class = name
+        return f
+    return decorator
+
+
+def _admit():
+    if request.method == 'OPTIONS' or request.endpoint is None:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    name = getattr(view, 'admission_class', DEFAULT_CLASS)
+    if name is None:
+        return None
+    try:
+        g.admission_ticket = classes[name].acquire()
+    except Saturated as e:
+        response = jsonify({'error': str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
+
+
+def _hand_to_response(response):
+    # Streamed responses keep running after the view returns, so the slot is
+    # held until the server closes the response
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        response.call_on_close(ticket.release)
+    return response
+
+
+def _release_on_teardown(error=None):
+    # Requests that never got a response (the handler chain itself failed)
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        ticket.release()
+
+
+def init_admission(app):
+    app.before_request(_admit)
+    app.after_request(_hand_to_response)
+    app.teardown_request(_release_on_teardown)
+
+
+def admission_stats():
+    return {name: admission_class.stats() for name, admission_class in classes.items()}
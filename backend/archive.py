@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from cache_bus import execute_write
+from database import DEFAULT_LAB_ID, current_shard_key, get_db_connection, hot_statement, use_lab
+from results import RESULT_COLUMNS, STORED_COLUMNS, results_from
+from sync import prune_tombstones
+
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '730'))
+ARCHIVE_BATCH_SIZE = 5000
+# Workers re-read the watermarks this often (it's a two-row table), and the
+# archiver waits out this TTL between raising a watermark and moving rows under
+# it, so no worker can still hold the old one when the first row leaves the hot table
+WATERMARK_TTL_SECONDS = 1
+
+# table -> (archive table, date column, columns)
+ARCHIVED_TABLES = {
+    'tests': ('tests_archive', 'test_date', STORED_COLUMNS),
+    'reports': ('reports_archive', 'generated_at', 'id, patient_id, generated_at'),
+}
+
+_watermarks = {}  # Per lab shard: {'loaded_at': ..., 'values': {...}}
+
+
+def _ensure_year_partition(db_cursor, archive_table, year):
+    """Split the catch-all partition so `year` gets its own partition."""
+    db_cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = %s AND partition_name = %s
+    ''', (archive_table, f'p{year}'))
+    if db_cursor.fetchone()[0]:
+        return
+    db_cursor.execute(f'''
+        ALTER TABLE {archive_table} REORGANIZE PARTITION pmax INTO (
+            PARTITION p{year} VALUES LESS THAN ({year + 1}),
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        )
+    ''')
+
+
+def archive_table_rows(conn, table, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move rows older than cutoff from table into its archive, one batch per transaction.
+
+    Each batch is copied and deleted in the same transaction, so an interrupted
+    run leaves no row in both tiers or in neither and can simply be re-run.
+
+    Candidates are found with a plain read on the date index and only those
+    rows are then locked by primary key. A locking read on the date range
+    would also lock the gaps it scans, blocking result inserts while it runs.
+    """
+    archive_table, date_column, columns = ARCHIVED_TABLES[table]
+    db_cursor = conn.cursor()
+    _ensure_year_partition(db_cursor, archive_table, datetime.now().year + 1)
+
+    # Readers start including the archive before any row moves into it
+    db_cursor.execute('''
+        INSERT INTO archive_state (table_name, archived_before) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE archived_before = GREATEST(archived_before, VALUES(archived_before))
+    ''', (table, cutoff))
+    conn.commit()
+    _watermarks.pop(current_shard_key(), None)
+    # Twice the TTL, to also outlast a read of the old value that was in flight at the commit
+    time.sleep(2 * WATERMARK_TTL_SECONDS)
+
+    moved = 0
+    while True:
+        db_cursor.execute(
+            f'SELECT id FROM {table} WHERE {date_column} < %s ORDER BY {date_column}, id LIMIT %s',
+            (cutoff, batch_size)
+        )
+        candidates = [row[0] for row in db_cursor.fetchall()]
+        if not candidates:
+            conn.rollback()
+            break
+        # Recheck under the lock: a candidate may have been changed or deleted since the read
+        db_cursor.execute(
+            f"SELECT id FROM {table} WHERE id IN ({', '.join(['%s'] * len(candidates))}) "
+            f'AND {date_column} < %s FOR UPDATE',
+            candidates + [cutoff]
+        )
+        ids = [row[0] for row in db_cursor.fetchall()]
+        if not ids:
+            conn.rollback()
+            continue
+        placeholders = ', '.join(['%s'] * len(ids))
+        execute_write(
+            db_cursor,
+            f'INSERT IGNORE INTO {archive_table} ({columns}) '
+            f'SELECT {columns} FROM {table} WHERE id IN ({placeholders})',
+            ids
+        )
+        execute_write(db_cursor, f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+        conn.commit()
+        moved += len(ids)
+    return moved
+
+
+def run_archive(conn, max_age_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    cutoff = (datetime.now() - timedelta(days=max_age_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    started = time.perf_counter()
+    moved = {table: archive_table_rows(conn, table, cutoff, batch_size) for table in ARCHIVED_TABLES}
+    return {
+        'cutoff': cutoff.strftime('%Y-%m-%d %H:%M:%S'),
+        'moved': moved,
+        'tombstonesPruned': prune_tombstones(conn),
+        'elapsedSeconds': round(time.perf_counter() - started, 3),
+    }
+
+
+WATERMARK_QUERY = 'SELECT table_name, archived_before FROM archive_state'
+
+
+def cached_watermarks(shard_key):
+    """Return a shard's cached archive watermarks, or None once they are due for a reload."""
+    cached = _watermarks.get(shard_key)
+    if cached is None or time.monotonic() - cached['loaded_at'] > WATERMARK_TTL_SECONDS:
+        return None
+    return cached['values']
+
+
+def store_watermarks(shard_key, rows):
+    _watermarks[shard_key] = {'loaded_at': time.monotonic(), 'values': dict(rows)}
+    return _watermarks[shard_key]['values']
+
+
+def archived_before(db_cursor, table):
+    """Return the datetime below which rows of table may live in the archive, or None."""
+    shard_key = current_shard_key()
+    watermarks = cached_watermarks(shard_key)
+    if watermarks is None:
+        db_cursor.execute(WATERMARK_QUERY)
+        watermarks = store_watermarks(shard_key, db_cursor.fetchall())
+    return watermarks.get(table)
+
+
+def _tests_query_sql(ranged, archived):
+    conditions = 't.patient_id = %s'
+    if ranged:
+        conditions += ' AND DATE(t.test_date) BETWEEN %s AND %s'
+    sql = f'SELECT {RESULT_COLUMNS} FROM {results_from()} WHERE {conditions}'
+    if archived:
+        sql += f" UNION ALL SELECT {RESULT_COLUMNS} FROM {results_from('tests_archive')} WHERE {conditions}"
+    return sql + ' ORDER BY test_category, test_subcategory, test_date DESC'
+
+
+# The report's tests query comes in four shapes, each a prepared hot statement
+REPORT_TESTS_QUERIES = {
+    (ranged, archived): hot_statement(
+        'report_tests' + ('_range' if ranged else '') + ('_archive' if archived else ''),
+        _tests_query_sql(ranged, archived)
+    )
+    for ranged in (False, True)
+    for archived in (False, True)
+}
+
+
+def build_tests_query(patient_id, start=None, end=None, watermark=None):
+    """Build the report's tests query, reading through to the archive when the range needs it."""
+    ranged = bool(start and end)
+    params = [patient_id, start, end] if ranged else [patient_id]
+
+    needs_archive = watermark is not None
+    if needs_archive and ranged:
+        try:
+            needs_archive = datetime.strptime(start, '%Y-%m-%d') < watermark
+        except ValueError:
+            pass
+    if needs_archive:
+        params += params
+    return REPORT_TESTS_QUERIES[(ranged, needs_archive)], params
+
+
+def report_tests_query(db_cursor, patient_id, start=None, end=None):
+    return build_tests_query(patient_id, start, end, archived_before(db_cursor, 'tests'))
+
+
+if __name__ == '__main__':
+    # Meant for a nightly cron job, once per lab: python archive.py [max_age_days] [lab_id]
+    max_age_days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    use_lab(int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_LAB_ID)
+    conn = get_db_connection()
+    try:
+        result = run_archive(conn, max_age_days)
+    finally:
+        conn.close()
+    print(f"Archived rows older than {result['cutoff']}: {result['moved']} ({result['elapsedSeconds']}s)")
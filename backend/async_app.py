@@ -0,0 +1,216 @@
+"""Async serving path for the read-heavy endpoints.
+
+Serves the same URLs, auth and JSON shapes as run.py for
+
+    GET /api/reports/<id>
+    GET /api/patients
+    GET /api/reports/recent
+    GET /api/tests/categories
+
+on an asyncio event loop with an aiomysql pool per lab shard, so a request
+waiting on MySQL doesn't hold a worker thread. Run it next to run.py and route those
+GETs to it at the reverse proxy:
+
+    hypercorn async_app:app --bind 0.0.0.0:5001
+
+Install its dependencies with pip install -r requirements-async.txt;
+bench_async.py compares both paths under load.
+"""
+import asyncio
+import json
+import os
+from functools import wraps
+
+import aiomysql
+import jwt
+from dotenv import load_dotenv
+from quart import Quart, Response, request
+from quart_cors import cors
+
+from archive import WATERMARK_QUERY, build_tests_query, cached_watermarks, store_watermarks
+from database import DEFAULT_LAB_ID, shard_config, shard_for_lab
+from reports import ARTIFACT_QUERY, FINGERPRINT_QUERY, REPORT_PREGENERATE, report_payload
+from rowmap import cursor_columns
+from serialization import PATIENT_ROW, compress_body, encode_json, group_test_categories, project_fields
+
+load_dotenv()
+
+ASYNC_POOL_SIZE = int(os.getenv('ASYNC_POOL_SIZE', '20'))  # Per lab shard
+
+app = Quart(__name__)
+app = cors(app, allow_origin='http://localhost:5173', allow_credentials=True,
+           allow_headers=['Content-Type', 'Authorization'], expose_headers=['Content-Type', 'Authorization'])
+
+SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+if not SECRET_KEY:
+    raise ValueError("No JWT_SECRET_KEY set in environment variables")
+
+
+def _respond(body, status=200):
+    response = Response(body, status=status, content_type='application/json')
+    if 200 <= status < 300:
+        body, encoding = compress_body(body, request.accept_encodings)
+        if encoding is not None:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+    return response
+
+
+def json_response(data, status=200):
+    return _respond(encode_json(data), status)
+
+
+def token_required(f):
+    # Same checks and error messages as run.token_required
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        token = None
+        auth_header = request.headers.get('Authorization')
+        if auth_header and auth_header.startswith('Bearer '):
+            token = auth_header.split(' ')[1]
+        if not token:
+            return json_response({'error': 'Token is missing'}, 401)
+        try:
+            request.user = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            return json_response({'error': 'Token has expired'}, 401)
+        except jwt.InvalidTokenError:
+            return json_response({'error': 'Invalid token'}, 401)
+        try:
+            request.shard = shard_for_lab(request.user.get('lab_id', DEFAULT_LAB_ID))
+        except LookupError as e:
+            return json_response({'error': str(e)}, 403)
+        return await f(*args, **kwargs)
+    return decorated
+
+
+@app.before_serving
+async def create_pools():
+    app.db_pools = {}
+    app.db_pools_lock = asyncio.Lock()
+
+
+async def lab_pool():
+    """Return the pool for the request's lab shard, opening it on first use."""
+    shard = request.shard
+    pool = app.db_pools.get(shard['key'])
+    if pool is None:
+        async with app.db_pools_lock:
+            pool = app.db_pools.get(shard['key'])
+            if pool is None:
+                config = shard_config(shard)
+                pool = app.db_pools[shard['key']] = await aiomysql.create_pool(
+                    host=config['host'],
+                    port=config.get('port', 3306),
+                    user=config['user'],
+                    password=config['password'],
+                    db=config['database'],
+                    minsize=1,
+                    maxsize=ASYNC_POOL_SIZE,
+                    autocommit=True
+                )
+    return pool
+
+
+@app.after_serving
+async def close_pools():
+    for pool in app.db_pools.values():
+        pool.close()
+        await pool.wait_closed()
+
+
+@app.route('/api/patients', methods=['GET'])
+@token_required
+async def get_patients():
+    try:
+        async with (await lab_pool()).acquire() as conn:
+            async with conn.cursor() as db_cursor:
+                await db_cursor.execute('SELECT * FROM patients WHERE deleted_at IS NULL ORDER BY created_at DESC')
+                patients = await db_cursor.fetchall()
+                columns = cursor_columns(db_cursor)
+        patient_list = PATIENT_ROW.map_rows(columns, patients)
+        return json_response(project_fields(patient_list, request.args.get('fields') or ''))
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+
+@app.route('/api/reports/<int:patient_id>', methods=['GET'])
+@token_required
+async def generate_report(patient_id):
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        fields = request.args.get('fields') or ''
+        async with (await lab_pool()).acquire() as conn:
+            async with conn.cursor() as db_cursor:
+                if REPORT_PREGENERATE and not (start and end):
+                    await db_cursor.execute(ARTIFACT_QUERY, (patient_id,))
+                    artifact = await db_cursor.fetchone()
+                    if artifact:
+                        await db_cursor.execute(FINGERPRINT_QUERY, (patient_id,))
+                        if tuple(await db_cursor.fetchone()) == tuple(artifact[1:]):
+                            # Stored payload is already JSON; no need to decode and re-encode it
+                            if not fields:
+                                return _respond(artifact[0].encode('utf-8'))
+                            return json_response(project_fields(json.loads(artifact[0]), fields))
+
+                await db_cursor.execute('SELECT * FROM patients WHERE id = %s AND deleted_at IS NULL', (patient_id,))
+                patient_row = await db_cursor.fetchone()
+                if not patient_row:
+                    return json_response({'error': 'Patient not found'}, 404)
+                patient_columns = cursor_columns(db_cursor)
+
+                watermarks = cached_watermarks(request.shard['key'])
+                if watermarks is None:
+                    await db_cursor.execute(WATERMARK_QUERY)
+                    watermarks = store_watermarks(request.shard['key'], await db_cursor.fetchall())
+                await db_cursor.execute(*build_tests_query(patient_id, start, end, watermarks.get('tests')))
+                tests_rows = await db_cursor.fetchall()
+                test_columns = cursor_columns(db_cursor)
+
+        return json_response(project_fields(report_payload(patient_columns, patient_row, test_columns, tests_rows), fields))
+    except Exception as e:
+        print(f"Error generating report: {str(e)}")
+        return json_response({'error': str(e)}, 500)
+
+
+@app.route('/api/reports/recent', methods=['GET'])
+@token_required
+async def get_recent_reports():
+    try:
+        async with (await lab_pool()).acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as db_cursor:
+                await db_cursor.execute('''
+                    SELECT r.*, p.full_name as patient_name
+                    FROM reports r
+                    JOIN patients p ON r.patient_id = p.id
+                    WHERE p.deleted_at IS NULL
+                    ORDER BY r.generated_at DESC
+                    LIMIT 10
+                ''')
+                reports = await db_cursor.fetchall()
+        return json_response(list(reports))
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+
+@app.route('/api/tests/categories', methods=['GET'])
+@token_required
+async def get_test_categories():
+    try:
+        async with (await lab_pool()).acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as db_cursor:
+                await db_cursor.execute('''
+                    SELECT id, name, category, subcategory, reference_range, unit, price
+                    FROM test_catalog
+                ''')
+                all_tests = await db_cursor.fetchall()
+        return json_response(group_test_categories(all_tests))
+    except Exception as e:
+        print(f"Error fetching test categories: {str(e)}")
+        return json_response({'error': str(e)}, 500)
+
+
+if __name__ == '__main__':
+    app.run(port=5001)
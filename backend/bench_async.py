@@ -0,0 +1,75 @@
+"""Compare the sync (run.py) and async (async_app.py) serving paths under concurrency.
+
+Start both servers against the same database, log in to get a token, then:
+
+    python bench_async.py --token <jwt> --path /api/reports/1 --concurrency 200 --requests 5000
+
+Each target gets the same number of requests with the same number in flight.
+Latency percentiles, throughput and error counts are printed per target.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def run_target(base_url, path, token, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = total
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        headers = {'Authorization': f'Bearer {token}', 'Accept-Encoding': 'gzip'}
+
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path, headers=headers)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sync-url', default='http://localhost:5000')
+    parser.add_argument('--async-url', default='http://localhost:5001')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--path', default='/api/patients')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, base_url in (('sync', args.sync_url), ('async', args.async_url)):
+        result = await run_target(base_url, args.path, args.token, args.concurrency, args.requests)
+        print(f"{name:>5}  {result['rps']:8.1f} req/s  mean {result['mean_ms']:7.1f} ms  "
+              f"p50 {result['p50_ms']:7.1f}  p95 {result['p95_ms']:7.1f}  p99 {result['p99_ms']:7.1f}  "
+              f"errors {result['errors']}/{result['requests']}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
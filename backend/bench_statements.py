@@ -0,0 +1,101 @@
+"""Compare hot statements run as plain text queries and as cached prepared statements.
+
+Runs against the database configured in .env (set LAB_ID for other labs):
+
+    python bench_statements.py --patient-id 1 --email admin@example.com --iterations 2000
+
+Each statement runs the same number of times on one pooled connection, first
+as text (parsed and planned by the server on every call), then through
+execute_statement (prepared once, executed over the binary protocol). Test
+result inserts are rolled back (the reference snapshot they use is kept). Per-call latency and the server's own
+statement counters are printed per mode.
+"""
+import argparse
+import os
+import statistics
+import time
+
+from database import DEFAULT_LAB_ID, execute_statement, get_db_connection, get_directory_connection, use_lab
+from archive import REPORT_TESTS_QUERIES
+from results import result_rows
+from run import INSERT_TEST_RESULT, LOGIN_QUERY
+
+COUNTERS = ('Com_select', 'Com_insert', 'Com_stmt_prepare', 'Com_stmt_execute')
+
+
+def session_counters(conn):
+    db_cursor = conn.cursor()
+    db_cursor.execute(f"SHOW SESSION STATUS WHERE Variable_name IN ({', '.join(['%s'] * len(COUNTERS))})", COUNTERS)
+    counters = {name: int(value) for name, value in db_cursor.fetchall()}
+    db_cursor.close()
+    return counters
+
+
+def run_text(conn, sql, params):
+    db_cursor = conn.cursor()
+    db_cursor.execute(sql, params)
+    if db_cursor.with_rows:
+        db_cursor.fetchall()
+    db_cursor.close()
+
+
+def run_prepared(conn, sql, params):
+    db_cursor = execute_statement(conn, sql, params)
+    if db_cursor.with_rows:
+        db_cursor.fetchall()
+
+
+def measure(conn, runner, sql, params, iterations):
+    runner(conn, sql, params)  # Warm up; for prepared mode this is the one prepare
+    before = session_counters(conn)
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        runner(conn, sql, params)
+        latencies.append(time.perf_counter() - started)
+    after = session_counters(conn)
+    conn.rollback()
+    latencies.sort()
+    return {
+        'mean_us': statistics.mean(latencies) * 1e6,
+        'p95_us': latencies[int(len(latencies) * 0.95)] * 1e6,
+        # The counter query itself is a Com_select; don't count it
+        'counters': {name: after[name] - before[name] - (name == 'Com_select') for name in COUNTERS},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patient-id', type=int, required=True)
+    parser.add_argument('--email', required=True, help='Any user email, for the login lookup')
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    use_lab(int(os.getenv('LAB_ID', DEFAULT_LAB_ID)))
+    conn = get_db_connection()
+    try:
+        insert_params = result_rows(conn.cursor(), [{
+            'patient_id': args.patient_id, 'category': 'Bench', 'subcategory': 'Bench', 'name': 'Bench',
+            'value': '1', 'normal_range': '0-2', 'unit': 'mg/dL', 'test_date': '2024-01-01 00:00:00', 'note': None,
+        }])[0]
+        conn.commit()
+    finally:
+        conn.close()
+    cases = [
+        ('report_tests', get_db_connection, REPORT_TESTS_QUERIES[(False, False)], (args.patient_id,)),
+        ('login_user', get_directory_connection, LOGIN_QUERY, (args.email,)),
+        ('insert_test_result', get_db_connection, INSERT_TEST_RESULT, insert_params),
+    ]
+    for name, connect, sql, params in cases:
+        conn = connect()
+        try:
+            for mode, runner in (('text', run_text), ('prepared', run_prepared)):
+                result = measure(conn, runner, sql, params, args.iterations)
+                counters = '  '.join(f'{key} {value}' for key, value in result['counters'].items())
+                print(f"{name:>20} {mode:>8}  mean {result['mean_us']:8.1f} us  p95 {result['p95_us']:8.1f} us  {counters}")
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from database import current_shard_key, get_db_connection, get_dedicated_connection, get_directory_connection
+
+# How stale another worker's view of a write can be, at most. Each worker
+# runs one primary-key scan of cache_versions per interval, and only when a
+# cached read actually happens.
+POLL_INTERVAL_SECONDS = float(os.getenv('CACHE_BUS_POLL_SECONDS', '1'))
+
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '1000'))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv('QUERY_CACHE_TTL_SECONDS', '300'))
+
+DIRECTORY = 'directory'
+WRITE_TABLE_PATTERN = re.compile(
+    r'^\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+`?(\w+)',
+    re.IGNORECASE | re.MULTILINE
+)
+
+_lock = threading.Lock()
+# One view of cache_versions per database: the directory and each lab shard
+_states = {}
+_cache_lock = threading.Lock()
+# Query cache, least recently used first: key -> (expires_at, tag versions, result)
+_entries = OrderedDict()
+# Tables some CachedQuery reads; only writes to these are published
+_tagged_tables = set()
+# Bumped by this worker's own writes, so it never waits for a poll to see them
+_generations = {}
+_metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'bypassed': 0}
+
+
+def publish(db_cursor, *names):
+    """Bump the version of each table on the caller's cursor.
+
+    Call it before the caller commits, so the bump becomes visible to other
+    workers atomically with the write that caused it. This worker stops
+    serving its own entries straight away. The cursor must be on the
+    database the table lives in: the directory for users and lab_info,
+    else the lab's shard.
+    """
+    db_cursor.executemany('''
+        INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+    ''', [(name,) for name in names])
+    with _cache_lock:
+        for name in names:
+            _generations[name] = _generations.get(name, 0) + 1
+
+
+def _poll(state, directory):
+    conn = state['conn']
+    if conn is None:
+        # Held across requests, so it stays out of the pool
+        conn = state['conn'] = get_dedicated_connection(directory)
+        conn.autocommit = True  # Each poll must see the latest committed versions
+    else:
+        conn.ping(reconnect=True, attempts=2, delay=0)
+    db_cursor = conn.cursor()
+    db_cursor.execute('SELECT name, version FROM cache_versions')
+    versions = dict(db_cursor.fetchall())
+    db_cursor.close()
+    return versions
+
+
+def current_versions(directory=False):
+    """Return the cache versions of the directory or of the current lab's shard, or None."""
+    shard_key = DIRECTORY if directory else current_shard_key()
+    with _lock:
+        state = _states.setdefault(shard_key, {'versions': {}, 'polled_at': 0.0, 'conn': None})
+        if time.monotonic() - state['polled_at'] >= POLL_INTERVAL_SECONDS:
+            try:
+                state['versions'] = _poll(state, directory)
+                state['polled_at'] = time.monotonic()
+            except Exception as e:
+                # Without a fresh view we can't trust any entry; callers fall through to the loader
+                print(f"Cache bus poll failed for {shard_key}: {str(e)}")
+                if state['conn'] is not None:
+                    try:
+                        state['conn'].close()
+                    except Exception:
+                        pass
+                state['conn'] = None
+                return None
+        return state['versions']
+
+
+class CachedQuery:
+    """A read that opts into this worker's query result cache.
+
+    Results are keyed by lab shard, SQL and parameters, and tagged with the
+    tables the query reads. An entry is served until its TTL runs out or
+    any of its tables is written through execute_write() or publish(), in
+    any worker. Least recently used entries are evicted past
+    QUERY_CACHE_MAX_ENTRIES. Cached results are shared, so treat them as
+    read-only.
+    """
+
+    def __init__(self, sql, tables, ttl=None, one=False, directory=False, shape=None):
+        self.sql = sql
+        self.tables = tuple(tables)
+        self.ttl = QUERY_CACHE_TTL_SECONDS if ttl is None else ttl
+        self.one = one
+        self.directory = directory
+        self.shape = shape
+        _tagged_tables.update(self.tables)
+
+    def _load(self, params):
+        # Always the primary: a lagging replica could pair old rows with the new version
+        conn = get_directory_connection() if self.directory else get_db_connection(read_only=False)
+        try:
+            db_cursor = conn.cursor(dictionary=True, buffered=True)
+            db_cursor.execute(self.sql, params)
+            result = db_cursor.fetchone() if self.one else db_cursor.fetchall()
+        finally:
+            conn.close()
+        return self.shape(result) if self.shape else result
+
+    def fetch(self, *params):
+        versions = current_versions(self.directory)
+        if versions is None:
+            _metrics['bypassed'] += 1
+            return self._load(params)
+        key = (DIRECTORY if self.directory else current_shard_key(), self.sql, params)
+        with _cache_lock:
+            tag = tuple((versions.get(table, 0), _generations.get(table, 0)) for table in self.tables)
+            entry = _entries.get(key)
+            if entry is not None and entry[0] > time.monotonic() and entry[1] == tag:
+                _entries.move_to_end(key)
+                _metrics['hits'] += 1
+                return entry[2]
+            _metrics['misses'] += 1
+
+        value = self._load(params)
+
+        with _cache_lock:
+            # A write in this worker while loading makes the result unsafe to keep
+            if tag == tuple((versions.get(table, 0), _generations.get(table, 0)) for table in self.tables):
+                _entries[key] = (time.monotonic() + self.ttl, tag, value)
+                _entries.move_to_end(key)
+                while len(_entries) > QUERY_CACHE_MAX_ENTRIES:
+                    _entries.popitem(last=False)
+                    _metrics['evictions'] += 1
+        return value
+
+
+def written_tables(sql):
+    return [table for table in WRITE_TABLE_PATTERN.findall(sql) if table in _tagged_tables]
+
+
+WriteResult = namedtuple('WriteResult', 'rowcount lastrowid')
+
+
+def execute_write(db_cursor, sql, params=None, many=False):
+    """Run a write and publish the cached tables it touches, before the caller commits.
+
+    Returns the write's rowcount and lastrowid; read them from here, since
+    publishing runs another statement on the same cursor.
+    """
+    if many:
+        db_cursor.executemany(sql, params)
+    else:
+        db_cursor.execute(sql, params)
+    result = WriteResult(db_cursor.rowcount, db_cursor.lastrowid)
+    tables = written_tables(sql)
+    if tables:
+        publish(db_cursor, *tables)
+    return result
+
+
+def query_cache_stats():
+    with _cache_lock:
+        lookups = _metrics['hits'] + _metrics['misses']
+        return {
+            **_metrics,
+            'entries': len(_entries),
+            'hitRatio': round(_metrics['hits'] / lookups, 4) if lookups else None,
+        }
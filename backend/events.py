@@ -0,0 +1,227 @@
+import json
+import queue
+import threading
+import time
+from datetime import date, datetime
+
+from database import current_lab, get_db_connection, reset_lab, use_lab
+from purge import DELETED_PATIENT_IDS
+
+SUBSCRIBER_QUEUE_SIZE = 100
+KEEPALIVE_SECONDS = 15
+# How often open streams look for writes made by other worker processes
+CHANGE_CHECK_SECONDS = 2
+
+# Rows of deleted patients still waiting for the purger don't count
+COUNTERS_QUERY = f'''
+    SELECT
+        (SELECT COUNT(*) FROM patients WHERE deleted_at IS NULL),
+        (SELECT COUNT(*) FROM tests WHERE patient_id NOT IN ({DELETED_PATIENT_IDS}))
+            + (SELECT COUNT(*) FROM tests_archive WHERE patient_id NOT IN ({DELETED_PATIENT_IDS})),
+        (SELECT COUNT(*) FROM reports WHERE patient_id NOT IN ({DELETED_PATIENT_IDS}))
+            + (SELECT COUNT(*) FROM reports_archive WHERE patient_id NOT IN ({DELETED_PATIENT_IDS})),
+        (SELECT COUNT(*) FROM tests WHERE test_date >= CURDATE() AND patient_id NOT IN ({DELETED_PATIENT_IDS}))
+'''
+# Moves with every write the counters depend on, in any worker: inserts and
+# updates advance updated_at or the newest id, deletes leave sync tombstones
+# and soft deletes update the patient. Each part is a single index lookup.
+CHANGE_MARK_QUERY = '''
+    SELECT
+        (SELECT MAX(updated_at) FROM patients),
+        (SELECT MAX(updated_at) FROM tests),
+        (SELECT MAX(id) FROM reports),
+        (SELECT MAX(id) FROM sync_tombstones)
+'''
+
+
+class EventBroker:
+    """Fans one lab's write events out to its open dashboard streams in this process.
+
+    Dashboard counters are seeded from the database once and then kept up to
+    date by the write paths, so open dashboards never re-run the aggregates.
+    Writes handled by other worker processes are noticed through
+    CHANGE_MARK_QUERY, which open streams check every CHANGE_CHECK_SECONDS.
+    This worker's own writes move the mark along as they are published, so
+    only other workers' writes re-seed the counters, which are then pushed
+    to this worker's streams in a 'changed' event.
+    """
+
+    def __init__(self, lab_id):
+        self.lab_id = lab_id
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._counters = None
+        self._counters_date = None
+        self._mark = None
+        self._checked_at = 0.0
+
+    def _connect(self):
+        # Streams seed outside any request, so pin the lab explicitly
+        lab = use_lab(self.lab_id)
+        try:
+            return get_db_connection(read_only=False)
+        finally:
+            reset_lab(lab)
+
+    def _load_counters(self):
+        conn = self._connect()
+        try:
+            db_cursor = conn.cursor()
+            # The mark first: a write landing between the two queries shows up at the next check
+            db_cursor.execute(CHANGE_MARK_QUERY)
+            mark = db_cursor.fetchone()
+            db_cursor.execute(COUNTERS_QUERY)
+            patients, tests, reports, tests_today = db_cursor.fetchone()
+        finally:
+            conn.close()
+        return {
+            'totalPatients': int(patients),
+            'totalTests': int(tests),
+            'reportsGenerated': int(reports),
+            'testsToday': int(tests_today),
+        }, mark
+
+    def counters(self):
+        with self._lock:
+            stale = self._counters is None or self._counters_date != date.today()
+        if stale:
+            # Seed on first use and re-seed at midnight so testsToday starts over
+            counters, mark = self._load_counters()
+            with self._lock:
+                self._counters = counters
+                self._counters_date = date.today()
+                self._mark = mark
+        with self._lock:
+            return dict(self._counters)
+
+    def _read_mark(self):
+        conn = self._connect()
+        try:
+            db_cursor = conn.cursor()
+            db_cursor.execute(CHANGE_MARK_QUERY)
+            return db_cursor.fetchone()
+        finally:
+            conn.close()
+
+    def _advance_mark(self):
+        # After this worker's own write, whose effect is already counted, so
+        # the next check doesn't take it for another worker's. A write from
+        # elsewhere committing in the same instant is picked up by the next change.
+        try:
+            mark = self._read_mark()
+        except Exception as e:
+            print(f"Error reading change mark for lab {self.lab_id}: {str(e)}")
+            return
+        with self._lock:
+            self._mark = mark
+
+    def check_for_changes(self):
+        """Re-seed and push the counters if another worker wrote since they were seeded.
+
+        Rate-limited to once per CHANGE_CHECK_SECONDS however many streams call it.
+        """
+        with self._lock:
+            if self._counters is None or time.monotonic() - self._checked_at < CHANGE_CHECK_SECONDS:
+                return
+            self._checked_at = time.monotonic()
+            mark = self._mark
+        if self._read_mark() == mark:
+            return
+        counters, mark = self._load_counters()
+        with self._lock:
+            changed = counters != self._counters
+            self._counters = counters
+            self._counters_date = date.today()
+            self._mark = mark
+            subscribers = list(self._subscribers)
+        if changed:
+            self._send(subscribers, 'changed', {'counters': counters})
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event_type, data, **increments):
+        """Apply counter increments and send the event to every subscriber.
+
+        Does nothing beyond bumping counters when nobody is listening.
+        """
+        with self._lock:
+            counted = self._counters is not None and self._counters_date == date.today()
+            if counted:
+                for name, amount in increments.items():
+                    self._counters[name] += amount
+            else:
+                self._counters = None  # Re-seed lazily; the seed query will already include this write
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        if counted:
+            self._advance_mark()
+        self._send(subscribers, event_type, {**data, 'counters': self.counters()})
+
+    def _send(self, subscribers, event_type, data):
+        message = format_event(event_type, data)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # A stalled client must not block writers; it misses events and resyncs on reconnect
+                pass
+
+    def refresh(self, event_type='counters', data=None):
+        """Re-seed counters after writes whose effect can't be counted, like cascading deletes."""
+        with self._lock:
+            self._counters = None
+        self.publish(event_type, data or {})
+
+
+def format_event(event_type, data):
+    def default(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return str(value)
+    return f'event: {event_type}\ndata: {json.dumps(data, default=default)}\n\n'
+
+
+def stream_events(broker):
+    """Yield an initial counters event, then every published event, with keepalives."""
+    subscriber = broker.subscribe()
+    try:
+        yield format_event('counters', {'counters': broker.counters()})
+        last_sent = time.monotonic()
+        while True:
+            try:
+                broker.check_for_changes()
+            except Exception as e:
+                print(f"Error checking lab {broker.lab_id} for changes: {str(e)}")
+            try:
+                message = subscriber.get(timeout=CHANGE_CHECK_SECONDS)
+            except queue.Empty:
+                if time.monotonic() - last_sent < KEEPALIVE_SECONDS:
+                    continue
+                message = ': keepalive\n\n'
+            last_sent = time.monotonic()
+            yield message
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(lab_id=None):
+    """Return the broker for a lab, defaulting to the current request's lab."""
+    if lab_id is None:
+        lab_id = current_lab()
+    with _brokers_lock:
+        if lab_id not in _brokers:
+            _brokers[lab_id] = EventBroker(lab_id)
+        return _brokers[lab_id]
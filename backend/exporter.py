@@ -0,0 +1,276 @@
+import csv
+import io
+import json
+import os
+import sys
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+from mysql.connector import FieldType
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional
+    pyarrow = None
+
+from archive import ARCHIVED_TABLES, archived_before
+from database import DEFAULT_LAB_ID, get_db_connection, use_lab
+from purge import DELETED_PATIENT_IDS
+from results import RESULT_COLUMNS, results_from
+
+FETCH_SIZE = 2000
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# entity -> (SELECT without WHERE from {table}, column the date range applies to, filter hiding deleted patients)
+EXPORT_QUERIES = {
+    'patients': (
+        'SELECT id, full_name, age, gender, contact_number, email, patient_code, address, ref_by, created_at '
+        'FROM {table} p',
+        'p.created_at',
+        'p.deleted_at IS NULL',
+    ),
+    'tests': (
+        f'SELECT {RESULT_COLUMNS} FROM {results_from("{table}")}',
+        't.test_date',
+        f't.patient_id NOT IN ({DELETED_PATIENT_IDS})',
+    ),
+    'reports': (
+        'SELECT r.id, r.patient_id, r.generated_at FROM {table} r',
+        'r.generated_at',
+        f'r.patient_id NOT IN ({DELETED_PATIENT_IDS})',
+    ),
+}
+
+TESTS_WITH_PATIENTS = (
+    'SELECT t.id, t.patient_id, p.patient_code, p.full_name, r.category AS test_category, '
+    'r.subcategory AS test_subcategory, r.name AS test_name, t.test_value, r.reference_range AS normal_range, '
+    'r.unit, t.test_date, n.note AS additional_note, t.created_at '
+    f'FROM {results_from("{table}")} JOIN patients p ON t.patient_id = p.id'
+)
+
+
+def build_export_query(entity, start=None, end=None, with_patients=False, watermark=None):
+    """Build the export query; watermark is the entity's archive watermark, if it has one.
+
+    Ranges starting before the watermark (or open ranges) also read the
+    archive table, so rows the archiver moved are still exported.
+    """
+    if entity not in EXPORT_QUERIES:
+        raise ValueError(f'Unknown export entity: {entity}')
+    sql, date_column, live_condition = EXPORT_QUERIES[entity]
+    if entity == 'tests' and with_patients:
+        sql = TESTS_WITH_PATIENTS
+    params = []
+    conditions = [live_condition]
+    if start:
+        conditions.append(f'{date_column} >= %s')
+        params.append(start)
+    if end:
+        # Inclusive end date, written as a half-open range so the index on the column stays usable
+        conditions.append(f'{date_column} < DATE_ADD(%s, INTERVAL 1 DAY)')
+        params.append(end)
+    where = ' WHERE ' + ' AND '.join(conditions)
+
+    archived = (entity in ARCHIVED_TABLES and watermark is not None
+                and (not start or datetime.strptime(start, '%Y-%m-%d') < watermark))
+    if not archived:
+        return sql.format(table=entity) + where + f' ORDER BY {date_column.split(".")[0]}.id', params
+    archive_table = ARCHIVED_TABLES[entity][0]
+    union = f'{sql.format(table=entity)}{where} UNION ALL {sql.format(table=archive_table)}{where} ORDER BY id'
+    return union, params + params
+
+
+def _to_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=' ') if isinstance(value, datetime) else value.isoformat()
+    return str(value)
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _iter_csv(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows([_to_text(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _iter_ndjson(columns, batches):
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(columns, map(_to_json_value, row))), ensure_ascii=False) + '\n'
+            for row in rows
+        ).encode('utf-8')
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+_INTEGER_TYPES = {FieldType.TINY, FieldType.SHORT, FieldType.INT24, FieldType.LONG, FieldType.LONGLONG, FieldType.YEAR}
+_FLOAT_TYPES = {FieldType.FLOAT, FieldType.DOUBLE, FieldType.DECIMAL, FieldType.NEWDECIMAL}
+
+
+def _parquet_type(type_code):
+    if type_code in _INTEGER_TYPES:
+        return pyarrow.int64()
+    if type_code in _FLOAT_TYPES:
+        return pyarrow.float64()
+    if type_code in (FieldType.DATE, FieldType.NEWDATE):
+        return pyarrow.date32()
+    if type_code in (FieldType.DATETIME, FieldType.TIMESTAMP):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+
+def _parquet_schema(description):
+    # From the result set's column types, not the first batch: a column that is
+    # all NULL there would be typed null and make later batches fail to write
+    return pyarrow.schema([(column[0], _parquet_type(column[1])) for column in description])
+
+
+def _to_parquet_value(value, field_type):
+    if value is None:
+        return None
+    if pyarrow.types.is_string(field_type):
+        return _to_text(value)
+    if pyarrow.types.is_floating(field_type):
+        return float(value)
+    return value
+
+
+def _iter_parquet(schema, batches):
+    # Each fetched batch becomes one row group, so only one batch is ever held in memory
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='snappy')
+    for rows in batches:
+        writer.write_table(pyarrow.table({
+            field.name: pyarrow.array([_to_parquet_value(row[index], field.type) for row in rows], field.type)
+            for index, field in enumerate(schema)
+        }, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_export(conn, entity, fmt, start=None, end=None, with_patients=False, compress=False):
+    """Yield the encoded export as byte chunks, fetching FETCH_SIZE rows at a time.
+
+    Uses an unbuffered cursor so MySQL streams the result set instead of the
+    client materialising it. The connection is closed when the generator ends.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+    if fmt == 'parquet' and pyarrow is None:
+        raise ValueError('Parquet export requires pyarrow to be installed')
+    watermark = None
+    if entity in ARCHIVED_TABLES:
+        watermark_cursor = conn.cursor()
+        watermark = archived_before(watermark_cursor, entity)
+        watermark_cursor.close()
+    sql, params = build_export_query(entity, start, end, with_patients, watermark)
+
+    def generate():
+        try:
+            db_cursor = conn.cursor(buffered=False)
+            db_cursor.execute(sql, params)
+            columns = list(db_cursor.column_names)
+
+            def batches():
+                while True:
+                    rows = db_cursor.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    yield rows
+
+            if fmt == 'parquet':
+                chunks = _iter_parquet(_parquet_schema(db_cursor.description), batches())
+            else:
+                chunks = {'csv': _iter_csv, 'ndjson': _iter_ndjson}[fmt](columns, batches())
+            if compress:
+                chunks = _gzip(chunks)
+            yield from chunks
+        finally:
+            conn.close()
+
+    return generate()
+
+
+def export_filename(entity, fmt, start=None, end=None, compress=False):
+    name = entity
+    if start or end:
+        name += f"_{start or 'begin'}_{end or 'now'}"
+    name += '.' + FORMATS[fmt][1]
+    if compress:
+        name += '.gz'
+    return name
+
+
+if __name__ == '__main__':
+    # Command line export to stdout, e.g.
+    #   python exporter.py tests csv 2025-01-01 2025-12-31 > tests_2025.csv
+    # Set LAB_ID to export another lab's shard.
+    if len(sys.argv) < 3:
+        print('Usage: python exporter.py <patients|tests|reports> <csv|ndjson|parquet> [start] [end]')
+        sys.exit(1)
+    entity, fmt = sys.argv[1], sys.argv[2]
+    start = sys.argv[3] if len(sys.argv) > 3 else None
+    end = sys.argv[4] if len(sys.argv) > 4 else None
+    use_lab(int(os.getenv('LAB_ID', DEFAULT_LAB_ID)))
+    for chunk in iter_export(get_db_connection(), entity, fmt, start, end):
+        sys.stdout.buffer.write(chunk)
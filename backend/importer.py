@@ -0,0 +1,372 @@
+import csv
+import os
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+try:
+    import openpyxl
+except ImportError:  # Excel support is optional
+    openpyxl = None
+
+from database import DEFAULT_LAB_ID, get_db_connection, use_lab
+from results import INSERT_RESULT_COLUMNS, result_rows
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 500
+# Raised by the CSV reader partway through a file; earlier chunks are already committed
+READ_ERRORS = (UnicodeDecodeError, csv.Error)
+
+# Header aliases (lowercased, without spaces/underscores) -> internal field name.
+# Both the API's camelCase names and the DB's snake_case names are accepted.
+PATIENT_HEADERS = {
+    'fullname': 'full_name',
+    'name': 'full_name',
+    'age': 'age',
+    'gender': 'gender',
+    'contactnumber': 'contact_number',
+    'phone': 'contact_number',
+    'email': 'email',
+    'patientcode': 'patient_code',
+    'address': 'address',
+    'refby': 'ref_by',
+}
+
+RESULT_HEADERS = {
+    'patientcode': 'patient_code',
+    'category': 'category',
+    'testcategory': 'category',
+    'subcategory': 'subcategory',
+    'testsubcategory': 'subcategory',
+    'testname': 'test_name',
+    'value': 'value',
+    'testvalue': 'value',
+    'normalrange': 'normal_range',
+    'unit': 'unit',
+    'testdate': 'test_date',
+    'notes': 'notes',
+    'additionalnote': 'notes',
+}
+
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%d/%m/%Y']
+
+
+def _normalize_header(header):
+    return str(header or '').strip().lower().replace('_', '').replace(' ', '')
+
+
+def _clean(value):
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def _iter_excel_rows(file_obj):
+    if openpyxl is None:
+        raise ValueError('Excel import requires openpyxl to be installed')
+    # read_only mode streams rows from the sheet instead of building the whole workbook
+    workbook = openpyxl.load_workbook(file_obj, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = next(rows, None)
+        if headers is None:
+            return
+        for values in rows:
+            yield dict(zip(headers, values))
+    finally:
+        workbook.close()
+
+
+def iter_rows(file_obj, filename):
+    """Yield one dict per data row of a CSV or Excel file without reading it whole."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        yield from _iter_excel_rows(file_obj)
+    else:
+        yield from csv.DictReader(_decoded_lines(file_obj))
+
+
+def _decoded_lines(file_obj):
+    # Decoded a line at a time rather than in TextIOWrapper's 8 KB blocks, so
+    # invalid bytes fail the row they are in and every row before it is imported
+    for index, line in enumerate(file_obj):
+        yield line.decode('utf-8-sig' if index == 0 else 'utf-8')
+
+
+def _map_row(raw, headers):
+    row = {}
+    for key, value in raw.items():
+        field = headers.get(_normalize_header(key))
+        if field:
+            row[field] = value
+    return row
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f'Unrecognised date: {value}')
+
+
+def _validate_patient(raw):
+    row = _map_row(raw, PATIENT_HEADERS)
+    for field in ['patient_code', 'full_name', 'age', 'gender', 'contact_number', 'email', 'address']:
+        if not _clean(row.get(field)):
+            raise ValueError(f'Missing required field: {field}')
+    try:
+        age = int(float(_clean(row['age'])))
+    except ValueError:
+        raise ValueError(f"Invalid age: {row['age']}")
+    if age < 0 or age > 150:
+        raise ValueError(f'Invalid age: {age}')
+    return (
+        _clean(row['full_name']),
+        age,
+        _clean(row['gender']),
+        _clean(row['contact_number']),
+        _clean(row['email']),
+        _clean(row['patient_code']),
+        _clean(row['address']),
+        _clean(row.get('ref_by')),
+    )
+
+
+def _validate_result(raw, catalog):
+    row = _map_row(raw, RESULT_HEADERS)
+    for field in ['patient_code', 'category', 'subcategory', 'test_name', 'value']:
+        if not _clean(row.get(field)):
+            raise ValueError(f'Missing required field: {field}')
+    category = _clean(row['category'])
+    subcategory = _clean(row['subcategory'])
+    test_name = _clean(row['test_name'])
+    catalog_entry = catalog.get((category.lower(), subcategory.lower(), test_name.lower()))
+    if catalog_entry is None:
+        raise ValueError(f'Test not in catalog: {category} / {subcategory} / {test_name}')
+    reference_range, unit = catalog_entry
+    test_date = _parse_date(_clean(row['test_date'])) if _clean(row.get('test_date')) else datetime.now().replace(microsecond=0)
+    return {
+        'patient_code': _clean(row['patient_code']),
+        'category': category,
+        'subcategory': subcategory,
+        'test_name': test_name,
+        'value': _clean(row['value']),
+        'normal_range': _clean(row.get('normal_range')) or reference_range,
+        'unit': _clean(row.get('unit')) or unit,
+        'test_date': test_date,
+        'notes': _clean(row.get('notes')) or None,
+    }
+
+
+def _load_catalog(db_cursor):
+    db_cursor.execute('SELECT name, category, subcategory, reference_range, unit FROM test_catalog')
+    return {
+        (category.lower(), subcategory.lower(), name.lower()): (reference_range, unit)
+        for name, category, subcategory, reference_range, unit in db_cursor.fetchall()
+    }
+
+
+def _upsert_patients(db_cursor, records):
+    """Insert patients, updating existing ones with the same code.
+
+    Returns (row_number, error) pairs for rows whose code belongs to a
+    deleted patient: updating it would import data the purger then removes.
+    """
+    codes = list({record[5] for _, record in records})
+    placeholders = ', '.join(['%s'] * len(codes))
+    # Locks the existing rows so a delete can't slip in between this check and the upsert
+    db_cursor.execute(
+        f'SELECT patient_code, deleted_at FROM patients WHERE patient_code IN ({placeholders}) FOR UPDATE', codes
+    )
+    deleted = {code for code, deleted_at in db_cursor.fetchall() if deleted_at is not None}
+    rejected = [
+        (row_number, f'Patient code belongs to a deleted patient: {record[5]}')
+        for row_number, record in records if record[5] in deleted
+    ]
+    records = [record for _, record in records if record[5] not in deleted]
+    if not records:
+        return rejected
+    db_cursor.executemany('''
+        INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address, ref_by)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            full_name = VALUES(full_name), age = VALUES(age), gender = VALUES(gender),
+            contact_number = VALUES(contact_number), email = VALUES(email),
+            address = VALUES(address), ref_by = VALUES(ref_by)
+    ''', records)
+    return rejected
+
+
+def _upsert_results(db_cursor, records):
+    """Insert results, updating rows that already exist for the same patient, test and date.
+
+    Returns (row_number, error) pairs for rows whose patient code is unknown.
+    """
+    codes = list({record['patient_code'] for _, record in records})
+    placeholders = ', '.join(['%s'] * len(codes))
+    db_cursor.execute(
+        f'SELECT id, patient_code FROM patients WHERE patient_code IN ({placeholders}) AND deleted_at IS NULL', codes
+    )
+    ids_by_code = {code: patient_id for patient_id, code in db_cursor.fetchall()}
+    rejected = [
+        (row_number, f"Unknown patient code: {record['patient_code']}")
+        for row_number, record in records if record['patient_code'] not in ids_by_code
+    ]
+    records = [record for _, record in records if record['patient_code'] in ids_by_code]
+    if not records:
+        return rejected
+
+    patient_ids = list(set(ids_by_code.values()))
+    dates = list({record['test_date'] for record in records})
+    db_cursor.execute(f'''
+        SELECT t.id, t.patient_id, r.category, r.subcategory, r.name, t.test_date
+        FROM tests t JOIN test_references r ON r.id = t.reference_id
+        WHERE t.patient_id IN ({', '.join(['%s'] * len(patient_ids))})
+          AND t.test_date IN ({', '.join(['%s'] * len(dates))})
+    ''', patient_ids + dates)
+    existing = {tuple(row[1:]): row[0] for row in db_cursor.fetchall()}
+
+    # Last row wins when a chunk repeats the same result
+    pending = {}
+    for record in records:
+        patient_id = ids_by_code[record['patient_code']]
+        key = (patient_id, record['category'], record['subcategory'], record['test_name'], record['test_date'])
+        pending[key] = record
+
+    rows = result_rows(db_cursor, [{
+        'patient_id': key[0],
+        'category': record['category'],
+        'subcategory': record['subcategory'],
+        'name': record['test_name'],
+        'value': record['value'],
+        'normal_range': record['normal_range'],
+        'unit': record['unit'],
+        'test_date': record['test_date'],
+        'note': record['notes'],
+    } for key, record in pending.items()])
+
+    inserts = []
+    updates = []
+    for key, row in zip(pending, rows):
+        if key in existing:
+            _, catalog_id, reference_id, note_id, value, _ = row
+            updates.append((catalog_id, reference_id, note_id, value, existing[key]))
+        else:
+            inserts.append(row)
+
+    if updates:
+        # Updated values don't change a stored report's fingerprint, so drop those reports
+        updated_patients = list({key[0] for key in pending if key in existing})
+        db_cursor.execute(
+            f"DELETE FROM report_artifacts WHERE patient_id IN ({', '.join(['%s'] * len(updated_patients))})",
+            updated_patients
+        )
+        db_cursor.executemany('''
+            UPDATE tests SET catalog_id = %s, reference_id = %s, note_id = %s, test_value = %s
+            WHERE id = %s
+        ''', updates)
+    if inserts:
+        db_cursor.executemany(f'INSERT INTO tests {INSERT_RESULT_COLUMNS} VALUES (%s, %s, %s, %s, %s, %s)', inserts)
+    return rejected
+
+
+def run_import(conn, kind, rows, chunk_size=CHUNK_SIZE):
+    """Validate and upsert rows chunk by chunk, committing once per chunk.
+
+    kind is 'patients' or 'results'. Memory use is bounded by chunk_size, so
+    arbitrarily large files can be imported. Returns a summary dict with row
+    counts, per-row errors (capped at MAX_REPORTED_ERRORS) and throughput.
+    If the file can't be read past some row, the rows before it are still
+    imported, the failure is recorded against that row and readFailedAtRow
+    is set.
+    """
+    if kind not in ('patients', 'results'):
+        raise ValueError(f'Unknown import kind: {kind}')
+
+    db_cursor = conn.cursor()
+    catalog = _load_catalog(db_cursor) if kind == 'results' else None
+    summary = {'kind': kind, 'processed': 0, 'imported': 0, 'failed': 0, 'errors': [], 'errorsTruncated': False,
+               'readFailedAtRow': None}
+
+    def record_error(row_number, message):
+        summary['failed'] += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+            summary['errors'].append({'row': row_number, 'error': message})
+        else:
+            summary['errorsTruncated'] = True
+
+    started = time.perf_counter()
+    # Row 1 is the header, so data rows are numbered from 2 like in a spreadsheet
+    numbered = enumerate(rows, start=2)
+    next_row = 2
+    read_error = None
+    while read_error is None:
+        chunk = []
+        try:
+            for row_number, raw in islice(numbered, chunk_size):
+                chunk.append((row_number, raw))
+                next_row = row_number + 1
+        except READ_ERRORS as e:
+            # Import what was read before the bad row, then stop
+            read_error = e
+            summary['readFailedAtRow'] = next_row
+        if not chunk:
+            break
+        valid = []
+        for row_number, raw in chunk:
+            summary['processed'] += 1
+            try:
+                if kind == 'patients':
+                    valid.append((row_number, _validate_patient(raw)))
+                else:
+                    valid.append((row_number, _validate_result(raw, catalog)))
+            except ValueError as e:
+                record_error(row_number, str(e))
+        if not valid:
+            continue
+        try:
+            if kind == 'patients':
+                rejected = _upsert_patients(db_cursor, valid)
+            else:
+                rejected = _upsert_results(db_cursor, valid)
+            conn.commit()
+            for row_number, message in rejected:
+                record_error(row_number, message)
+            summary['imported'] += len(valid) - len(rejected)
+        except Exception as e:
+            conn.rollback()
+            for row_number, _ in valid:
+                record_error(row_number, f'Chunk rejected: {e}')
+
+    if read_error is not None:
+        record_error(next_row, f'Could not read file from this row on: {read_error}')
+    elapsed = time.perf_counter() - started
+    summary['elapsedSeconds'] = round(elapsed, 3)
+    summary['rowsPerSecond'] = round(summary['processed'] / elapsed, 1) if elapsed > 0 else None
+    return summary
+
+
+if __name__ == '__main__':
+    # Command line import for files too large to push through an HTTP request:
+    #   python importer.py patients patients.csv
+    #   python importer.py results analyzer_export.xlsx
+    # Set LAB_ID to import into another lab's shard.
+    if len(sys.argv) != 3:
+        print('Usage: python importer.py <patients|results> <file>')
+        sys.exit(1)
+    kind, path = sys.argv[1], sys.argv[2]
+    use_lab(int(os.getenv('LAB_ID', DEFAULT_LAB_ID)))
+    conn = get_db_connection()
+    try:
+        with open(path, 'rb') as file_obj:
+            result = run_import(conn, kind, iter_rows(file_obj, path))
+    finally:
+        conn.close()
+    for error in result['errors']:
+        print(f"Row {error['row']}: {error['error']}")
+    print(f"Processed {result['processed']} rows: {result['imported']} imported, "
+          f"{result['failed']} failed ({result['rowsPerSecond']} rows/s)")
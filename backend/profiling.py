@@ -0,0 +1,151 @@
+"""On-demand profiling of single requests.
+
+An admin adds the X-Profile: 1 header (or ?_profile=1) to any token_required
+route, and that one request runs under cProfile. The response carries
+
+    X-Profile-Id     the stored profile, for GET /api/admin/profiles/<id>
+    Server-Timing    db;dur=<ms>, app;dur=<ms>, total;dur=<ms>
+
+Profiles are saved as pstats files (open them with python -m pstats or
+snakeviz) in PROFILE_DIR, next to a JSON summary; the newest PROFILE_KEEP
+are kept. Requests without the flag only pay for the flag check.
+
+DB time is the time spent inside mysql.connector, counted where application
+code calls into it; app time is the rest of the handler. Streamed response
+bodies are produced after the handler returns and are not included.
+"""
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+PROFILE_DIR = os.getenv('PROFILE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = '_profile'
+DB_PACKAGE = os.path.join('mysql', 'connector', '')
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# The interpreter runs one profiler at a time; a second flagged request runs unprofiled
+_profiler_lock = threading.Lock()
+_profiling = contextvars.ContextVar('profiling', default=False)
+
+
+def profile_requested(request):
+    return request.headers.get(PROFILE_HEADER) == '1' or request.args.get(PROFILE_PARAM) == '1'
+
+
+def profiling():
+    """True while the current request is being profiled."""
+    return _profiling.get()
+
+
+def _in_db_driver(func):
+    return DB_PACKAGE in func[0]
+
+
+def db_seconds(stats):
+    """Time spent in the database driver, counted at the calls application code made into it."""
+    total = 0.0
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not _in_db_driver(func):
+            continue
+        for caller, (_, _, _, cumulative) in callers.items():
+            if not _in_db_driver(caller):
+                total += cumulative
+    return total
+
+
+def run_profiled(view, *args, **kwargs):
+    """Call view under cProfile; returns (view's return value, summary or None if busy)."""
+    if not _profiler_lock.acquire(blocking=False):
+        return view(*args, **kwargs), None
+    token = _profiling.set(True)
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            rv = view(*args, **kwargs)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+    finally:
+        _profiling.reset(token)
+        _profiler_lock.release()
+
+    stats = pstats.Stats(profiler)
+    db = min(db_seconds(stats), elapsed)
+    summary = {
+        'totalMs': round(elapsed * 1000, 2),
+        'dbMs': round(db * 1000, 2),
+        'appMs': round((elapsed - db) * 1000, 2),
+    }
+    return rv, (profiler, summary)
+
+
+def save_profile(profiler, summary):
+    """Write the profile and its summary to PROFILE_DIR; returns its id."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f'{profile_id}.prof'))
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.json'), 'w') as meta:
+        json.dump({'id': profile_id, 'createdAt': datetime.now().isoformat(timespec='seconds'), **summary}, meta)
+    _prune()
+    return profile_id
+
+
+def _prune():
+    profiles = list_profiles()
+    for profile in profiles[PROFILE_KEEP:]:
+        for extension in ('prof', 'json'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, f"{profile['id']}.{extension}"))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    """Summaries of the stored profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as meta:
+                profiles.append(json.load(meta))
+        except (OSError, ValueError):
+            continue
+    profiles.sort(key=lambda profile: profile['createdAt'], reverse=True)
+    return profiles
+
+
+def profile_path(profile_id):
+    """Path of a stored pstats file, or None for unknown or malformed ids."""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, f'{profile_id}.prof')
+    return path if os.path.isfile(path) else None
+
+
+def top_functions(profile_id, limit=25):
+    """The functions with the most cumulative time, for a quick look without downloading."""
+    stats = pstats.Stats(profile_path(profile_id))
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [
+        {
+            'function': f'{filename}:{line}({name})',
+            'calls': calls,
+            'totalMs': round(own * 1000, 3),
+            'cumulativeMs': round(cumulative * 1000, 3),
+        }
+        for (filename, line, name), (_, calls, own, cumulative, _) in rows
+    ]
@@ -0,0 +1,175 @@
+"""Background purge of soft-deleted patients.
+
+delete_patient only stamps patients.deleted_at and queues a purge job, so the
+patient disappears at once without a large cascading delete. The purger then
+removes the patient's rows table by table in small batches, committing and
+pausing between batches so inserts into tests never wait long on its locks.
+Progress is committed with every batch in purge_jobs, so a crashed or
+restarted worker picks the job up where it stopped.
+
+Run python purge.py to drain the queue by hand (set LAB_ID for other labs).
+"""
+import os
+import threading
+import time
+
+from cache_bus import execute_write
+from database import DEFAULT_LAB_ID, get_db_connection, lab_ids, reset_lab, use_lab
+
+PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', '500'))
+PURGE_PAUSE_SECONDS = float(os.getenv('PURGE_PAUSE_SECONDS', '0.05'))
+# A job whose worker stops renewing its lease is taken over by another worker
+PURGE_LEASE_SECONDS = 60
+PURGE_POLL_SECONDS = 30
+
+# Subquery for hiding rows of patients that are deleted but not purged yet
+DELETED_PATIENT_IDS = 'SELECT id FROM patients WHERE deleted_at IS NOT NULL'
+
+# Dependent tables, emptied in this order before the patient row itself
+PURGED_TABLES = ('report_artifacts', 'reports', 'tests', 'reports_archive', 'tests_archive')
+
+JOB_COLUMNS = ('id, patient_id, status, current_table, rows_total, rows_purged, error, '
+               'created_at, started_at, finished_at')
+
+
+def soft_delete_patient(db_cursor, patient_id):
+    """Hide a patient and queue its purge in the caller's transaction; returns the job id."""
+    db_cursor.execute('UPDATE patients SET deleted_at = NOW() WHERE id = %s', (patient_id,))
+    db_cursor.execute('DELETE FROM report_artifacts WHERE patient_id = %s', (patient_id,))
+    db_cursor.execute('INSERT INTO purge_jobs (patient_id) VALUES (%s)', (patient_id,))
+    return db_cursor.lastrowid
+
+
+def _claim_job(conn):
+    """Take the oldest job that no live worker holds, or return None."""
+    db_cursor = conn.cursor()
+    while True:
+        db_cursor.execute('''
+            SELECT id, patient_id, rows_total FROM purge_jobs
+            WHERE status = 'pending'
+               OR (status = 'running' AND (lease_until IS NULL OR lease_until < NOW()))
+            ORDER BY id LIMIT 1
+        ''')
+        job = db_cursor.fetchone()
+        if not job:
+            conn.commit()
+            return None
+        # Only one worker wins the lease when several see the same job
+        db_cursor.execute('''
+            UPDATE purge_jobs
+            SET status = 'running', lease_until = NOW() + INTERVAL %s SECOND,
+                started_at = COALESCE(started_at, NOW())
+            WHERE id = %s AND (status = 'pending' OR lease_until IS NULL OR lease_until < NOW())
+        ''', (PURGE_LEASE_SECONDS, job[0]))
+        conn.commit()
+        if db_cursor.rowcount == 1:
+            return job
+
+
+def run_purge_job(conn, job_id, patient_id, rows_total=None):
+    db_cursor = conn.cursor()
+    if rows_total is None:
+        total = 0
+        for table in PURGED_TABLES:
+            db_cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE patient_id = %s', (patient_id,))
+            total += db_cursor.fetchone()[0]
+        db_cursor.execute('UPDATE purge_jobs SET rows_total = %s WHERE id = %s', (total + 1, job_id))
+        conn.commit()
+
+    for table in PURGED_TABLES:
+        while True:
+            deleted = execute_write(
+                db_cursor, f'DELETE FROM {table} WHERE patient_id = %s LIMIT %s', (patient_id, PURGE_BATCH_SIZE)
+            ).rowcount
+            db_cursor.execute('''
+                UPDATE purge_jobs
+                SET rows_purged = rows_purged + %s, current_table = %s, lease_until = NOW() + INTERVAL %s SECOND
+                WHERE id = %s
+            ''', (deleted, table, PURGE_LEASE_SECONDS, job_id))
+            conn.commit()
+            if deleted < PURGE_BATCH_SIZE:
+                break
+            time.sleep(PURGE_PAUSE_SECONDS)
+
+    # Nothing references the patient any more, so this no longer cascades
+    db_cursor.execute('DELETE FROM patients WHERE id = %s AND deleted_at IS NOT NULL', (patient_id,))
+    db_cursor.execute('''
+        UPDATE purge_jobs
+        SET status = 'done', rows_purged = rows_purged + %s, current_table = NULL,
+            lease_until = NULL, error = NULL, finished_at = NOW()
+        WHERE id = %s
+    ''', (db_cursor.rowcount, job_id))
+    conn.commit()
+
+
+def purge_pending(conn):
+    """Run queued jobs of the connection's lab until none are left; returns how many ran."""
+    ran = 0
+    while True:
+        job = _claim_job(conn)
+        if job is None:
+            return ran
+        job_id, patient_id, rows_total = job
+        try:
+            run_purge_job(conn, job_id, patient_id, rows_total)
+            ran += 1
+        except Exception as e:
+            # The lease runs out and the job is retried from the last committed batch
+            conn.rollback()
+            print(f"Error purging patient {patient_id} (job {job_id}): {str(e)}")
+            db_cursor = conn.cursor()
+            db_cursor.execute('UPDATE purge_jobs SET error = %s WHERE id = %s', (str(e)[:1000], job_id))
+            conn.commit()
+            return ran
+
+
+def list_purge_jobs(db_cursor, limit=50):
+    db_cursor.execute(f'SELECT {JOB_COLUMNS} FROM purge_jobs ORDER BY id DESC LIMIT %s', (limit,))
+    return db_cursor.fetchall()
+
+
+_wake = threading.Event()
+_lock = threading.Lock()
+_worker = None
+
+
+def _run_worker():
+    while True:
+        _wake.clear()
+        for lab_id in lab_ids():
+            lab = use_lab(lab_id)
+            try:
+                conn = get_db_connection(read_only=False)
+                try:
+                    purge_pending(conn)
+                finally:
+                    conn.close()
+            except Exception as e:
+                print(f"Purge worker error for lab {lab_id}: {str(e)}")
+            finally:
+                reset_lab(lab)
+        _wake.wait(PURGE_POLL_SECONDS)
+
+
+def start_purger():
+    """Start this process's purge worker once; it also resumes jobs left by a crash."""
+    global _worker
+    if _worker is not None:
+        return
+    with _lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name='patient-purger', daemon=True)
+            _worker.start()
+
+
+def wake_purger():
+    _wake.set()
+
+
+if __name__ == '__main__':
+    use_lab(int(os.getenv('LAB_ID', DEFAULT_LAB_ID)))
+    conn = get_db_connection(read_only=False)
+    try:
+        print(f'Purged {purge_pending(conn)} patients')
+    finally:
+        conn.close()
@@ -0,0 +1,161 @@
+"""Write-behind buffer for report view tracking.
+
+POST /api/reports/track only appends the view to an in-memory buffer. A
+flusher thread writes buffered views in multi-row inserts, once
+REPORT_VIEW_BATCH_SIZE are waiting or every REPORT_VIEW_FLUSH_SECONDS.
+
+The buffer is bounded: when it is full the caller inserts its own view
+synchronously, as before, instead of growing memory without limit. On a
+graceful shutdown an atexit hook flushes whatever is still buffered.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import mysql.connector
+
+from cache_bus import execute_write
+from database import current_lab, get_db_connection, reset_lab, use_lab
+
+REPORT_VIEW_BATCH_SIZE = int(os.getenv('REPORT_VIEW_BATCH_SIZE', '200'))
+REPORT_VIEW_FLUSH_SECONDS = float(os.getenv('REPORT_VIEW_FLUSH_SECONDS', '1'))
+REPORT_VIEW_BUFFER_SIZE = 10000
+RETRY_SECONDS = 5
+
+INSERT_VIEWS = 'INSERT INTO reports (patient_id, generated_at) VALUES (%s, %s)'
+
+_buffer = queue.Queue(maxsize=REPORT_VIEW_BUFFER_SIZE)
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wake = threading.Event()
+_worker = None
+_stats = {'buffered': 0, 'flushed': 0, 'batches': 0, 'synchronous': 0, 'dropped': 0}
+
+
+def _insert(lab_id, rows):
+    lab = use_lab(lab_id)
+    try:
+        conn = get_db_connection(read_only=False)
+    finally:
+        reset_lab(lab)
+    try:
+        db_cursor = conn.cursor()
+        try:
+            # mysql.connector turns this into a single multi-row INSERT
+            execute_write(db_cursor, INSERT_VIEWS, rows, many=True)
+            conn.commit()
+        except mysql.connector.Error:
+            # One bad row (say a patient purged after its view was buffered)
+            # fails the whole batch; insert one by one and keep the others
+            conn.rollback()
+            for written, row in enumerate(rows):
+                try:
+                    execute_write(db_cursor, INSERT_VIEWS, row)
+                    conn.commit()
+                except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+                    # The connection is gone, not the row: leave only the
+                    # unwritten rows in the chunk for flush() to requeue
+                    del rows[:written]
+                    raise
+                except mysql.connector.Error as e:
+                    conn.rollback()
+                    _stats['dropped'] += 1
+                    print(f"Dropping report view {row}: {str(e)}")
+    finally:
+        conn.close()
+
+
+def _drain():
+    batch = []
+    while len(batch) < REPORT_VIEW_BUFFER_SIZE:
+        try:
+            batch.append(_buffer.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _requeue(chunks):
+    for lab_id, rows in chunks:
+        for patient_id, viewed_at in rows:
+            try:
+                _buffer.put_nowait((lab_id, patient_id, viewed_at))
+            except queue.Full:
+                _stats['dropped'] += 1
+
+
+def flush():
+    """Write everything buffered so far; returns the number of views written."""
+    with _flush_lock:
+        by_lab = {}
+        for lab_id, patient_id, viewed_at in _drain():
+            by_lab.setdefault(lab_id, []).append((patient_id, viewed_at))
+        chunks = [
+            (lab_id, rows[start:start + REPORT_VIEW_BATCH_SIZE])
+            for lab_id, rows in by_lab.items()
+            for start in range(0, len(rows), REPORT_VIEW_BATCH_SIZE)
+        ]
+        written = 0
+        for index, (lab_id, rows) in enumerate(chunks):
+            try:
+                _insert(lab_id, rows)
+            except Exception:
+                # Put the unwritten views back so the next flush retries them
+                _requeue(chunks[index:])
+                raise
+            written += len(rows)
+            _stats['batches'] += 1
+            _stats['flushed'] += len(rows)
+        return written
+
+
+def _run_worker():
+    while True:
+        _wake.wait(REPORT_VIEW_FLUSH_SECONDS)
+        _wake.clear()
+        try:
+            flush()
+        except Exception as e:
+            print(f"Error flushing report views: {str(e)}")
+            time.sleep(RETRY_SECONDS)
+
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None:
+        return
+    with _lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name='report-view-flusher', daemon=True)
+            _worker.start()
+            atexit.register(_flush_at_exit)
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception as e:
+        print(f"Error flushing report views on shutdown: {str(e)}")
+
+
+def record_view(patient_id):
+    """Buffer a report view for the current lab, or insert it now if the buffer is full."""
+    _ensure_worker()
+    view = (current_lab(), patient_id, datetime.now())
+    try:
+        _buffer.put_nowait(view)
+    except queue.Full:
+        # Backpressure: the caller pays for its own insert rather than the buffer growing
+        _stats['synchronous'] += 1
+        _insert(view[0], [view[1:]])
+        return
+    _stats['buffered'] += 1
+    if _buffer.qsize() >= REPORT_VIEW_BATCH_SIZE:
+        _wake.set()
+
+
+def view_stats():
+    return {**_stats, 'pending': _buffer.qsize()}
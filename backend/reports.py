@@ -0,0 +1,189 @@
+import json
+import os
+import queue
+import re
+import threading
+
+from database import current_lab, execute_statement, get_db_connection, reset_lab, use_lab
+from archive import report_tests_query
+from rowmap import RowMapper, cursor_columns
+
+# When enabled, saving results queues a background rebuild of the patient's
+# report so GET /api/reports/<id> can serve the stored payload directly.
+REPORT_PREGENERATE = os.getenv('REPORT_PREGENERATE', '0') == '1'
+MAX_PENDING_REPORTS = 10000
+
+
+def compute_status(value, ref_range):
+    status = 'Normal'
+    ref = str(ref_range).replace('–', '-').replace(' ', '')
+    match = re.match(r'^(\d+(?:\.\d+)?)-(\d+(?:\.\d+)?)$', ref)
+    if match:
+        low, high = float(match.group(1)), float(match.group(2))
+        if float(value) < low:
+            status = 'Low'
+        elif float(value) > high:
+            status = 'High'
+    elif ref.startswith('<'):
+        try:
+            high = float(ref[1:])
+            if float(value) >= high:
+                status = 'High'
+        except:
+            pass
+    elif ref.lower().startswith('upto') or ref.lower().startswith('up to'):
+        try:
+            high = float(re.findall(r'\d+(?:\.\d+)?', ref)[0])
+            if float(value) > high:
+                status = 'High'
+        except:
+            pass
+    elif ref.lower() == 'positive':
+        if str(value).lower() != 'positive':
+            status = 'Abnormal'
+    elif ref.lower() == 'negative':
+        if str(value).lower() != 'negative':
+            status = 'Abnormal'
+    return status
+
+
+def build_report(conn, patient_id, start=None, end=None):
+    """Build the report payload for a patient, or return None if the patient doesn't exist."""
+    # Get patient information
+    db_cursor = conn.cursor()
+    db_cursor.execute('SELECT * FROM patients WHERE id = %s AND deleted_at IS NULL', (patient_id,))
+    patient_row = db_cursor.fetchone()
+    if not patient_row:
+        return None
+    patient_columns = cursor_columns(db_cursor)
+
+    # Fetch tests for the patient, filtered by test_date if start and end are provided.
+    # Ranges reaching past the archive watermark also read from tests_archive.
+    tests_cursor = execute_statement(conn, *report_tests_query(db_cursor, patient_id, start, end))
+    tests_rows = tests_cursor.fetchall()
+
+    return report_payload(patient_columns, patient_row, cursor_columns(tests_cursor), tests_rows)
+
+
+REPORT_PATIENT_ROW = RowMapper([
+    ('patientName', 'full_name'),
+    ('patientCode', 'patient_code'),
+    ('patientAge', 'age'),
+    ('patientGender', 'gender'),
+    ('contactNumber', 'contact_number'),
+    ('refBy', 'ref_by'),
+])
+
+REPORT_TEST_ROW = RowMapper([
+    ('id', 'id'),
+    ('testCategory', 'test_category'),
+    ('testSubcategory', 'test_subcategory'),
+    ('testName', 'test_name'),
+    ('testValue', 'test_value'),
+    ('normalRange', 'normal_range'),
+    ('unit', 'unit'),
+    ('additionalNote', 'additional_note'),
+    ('testDate', 'test_date', lambda value: value.strftime('%Y-%m-%d %H:%M:%S') if value else None),
+])
+
+
+def report_payload(patient_columns, patient_row, test_columns, tests_rows):
+    """Shape the patient row and raw tests rows into the report JSON, calculating statuses."""
+    report = REPORT_PATIENT_ROW.map_row(patient_columns, patient_row)
+    test_list = REPORT_TEST_ROW.map_rows(test_columns, tests_rows)
+    for test in test_list:
+        test['status'] = compute_status(test['testValue'], test['normalRange'])
+    report['tests'] = test_list
+    return report
+
+
+# Artifacts of soft-deleted patients are never served, even if a build finished after the delete
+ARTIFACT_QUERY = '''
+    SELECT a.payload, a.tests_count, a.latest_test_id FROM report_artifacts a
+    JOIN patients p ON p.id = a.patient_id AND p.deleted_at IS NULL
+    WHERE a.patient_id = %s
+'''
+# Any insert or delete of the patient's results changes the count or the newest id
+FINGERPRINT_QUERY = 'SELECT COUNT(*), COALESCE(MAX(id), 0) FROM tests WHERE patient_id = %s'
+
+
+def report_fingerprint(db_cursor, patient_id):
+    db_cursor.execute(FINGERPRINT_QUERY, (patient_id,))
+    return db_cursor.fetchone()
+
+
+def load_report_artifact(db_cursor, patient_id):
+    """Return the stored full report for a patient if it is still current, else None."""
+    db_cursor.execute(ARTIFACT_QUERY, (patient_id,))
+    artifact = db_cursor.fetchone()
+    if not artifact:
+        return None
+    payload, tests_count, latest_test_id = artifact
+    if tuple(report_fingerprint(db_cursor, patient_id)) != (tests_count, latest_test_id):
+        return None
+    return json.loads(payload)
+
+
+def pregenerate_report(patient_id):
+    conn = get_db_connection()
+    try:
+        db_cursor = conn.cursor()
+        # Take the fingerprint first: results saved while we build make the artifact stale, never falsely fresh
+        tests_count, latest_test_id = report_fingerprint(db_cursor, patient_id)
+        report = build_report(conn, patient_id)
+        if report is None:
+            return
+        db_cursor.execute('''
+            INSERT INTO report_artifacts (patient_id, payload, tests_count, latest_test_id)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE payload = VALUES(payload), tests_count = VALUES(tests_count),
+                latest_test_id = VALUES(latest_test_id), generated_at = CURRENT_TIMESTAMP
+        ''', (patient_id, json.dumps(report), tests_count, latest_test_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+_queue = queue.Queue(maxsize=MAX_PENDING_REPORTS)
+_pending = set()
+_lock = threading.Lock()
+_worker = None
+
+
+def _run_worker():
+    while True:
+        job = _queue.get()
+        lab_id, patient_id = job
+        with _lock:
+            _pending.discard(job)
+        lab = use_lab(lab_id)
+        try:
+            pregenerate_report(patient_id)
+        except Exception as e:
+            print(f"Error pre-generating report for patient {patient_id} of lab {lab_id}: {str(e)}")
+        finally:
+            reset_lab(lab)
+
+
+def enqueue_report(patient_id):
+    """Queue a background rebuild of a patient's report in the current lab.
+
+    No-op unless REPORT_PREGENERATE is on.
+    """
+    global _worker
+    if not REPORT_PREGENERATE:
+        return
+    job = (current_lab(), patient_id)
+    with _lock:
+        if job in _pending:
+            return
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name='report-pregenerator', daemon=True)
+            _worker.start()
+        _pending.add(job)
+    try:
+        _queue.put_nowait(job)
+    except queue.Full:
+        # The GET endpoint falls back to live generation, so dropping is safe
+        with _lock:
+            _pending.discard(job)
@@ -0,0 +1,132 @@
+"""Test result rows and the reference snapshots they point to.
+
+A row in tests (or tests_archive) holds only the patient, the value, the
+date and three ids:
+
+    catalog_id    the test_catalog entry, when the test is in the catalog
+    reference_id  the test_references snapshot of category, subcategory,
+                  name, reference range and unit the result was entered with
+    note_id       the panel's note in test_notes, shared by its results
+
+Snapshots are immutable and content-addressed, so any number of results
+share one, and changing the catalog adds a snapshot (with the next version
+for that entry) instead of rewriting history: old reports keep the range
+they were printed with. Queries that need the old flat columns select
+RESULT_COLUMNS from results_from(), which returns them under their old names.
+"""
+import hashlib
+
+# Columns a row of tests / tests_archive stores, in the order archive.py copies them
+STORED_COLUMNS = 'id, patient_id, catalog_id, reference_id, note_id, test_value, test_date, created_at'
+
+RESULT_COLUMNS = (
+    't.id, t.patient_id, r.category AS test_category, r.subcategory AS test_subcategory, '
+    'r.name AS test_name, t.test_value, r.reference_range AS normal_range, r.unit, t.test_date, '
+    'n.note AS additional_note, t.created_at'
+)
+
+
+def results_from(table='tests'):
+    return (f'{table} t JOIN test_references r ON r.id = t.reference_id '
+            'LEFT JOIN test_notes n ON n.id = t.note_id')
+
+
+# Listing and sync query: the flat columns plus the row's own catalog id and change time
+RESULT_LISTING = f'SELECT {RESULT_COLUMNS}, t.catalog_id, t.updated_at FROM {results_from()}'
+# The same for archived rows, which don't change after archival and keep no updated_at
+ARCHIVED_RESULT_LISTING = (f'SELECT {RESULT_COLUMNS}, t.catalog_id, t.created_at AS updated_at '
+                           f"FROM {results_from('tests_archive')}")
+
+INSERT_RESULT_COLUMNS = '(patient_id, catalog_id, reference_id, note_id, test_value, test_date)'
+
+
+def _digest(*parts):
+    # NULL and '' must hash differently, hence the NUL stand-in
+    return hashlib.sha1('\x1f'.join('\0' if part is None else str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def _catalog_ids(db_cursor, keys):
+    """Map (category, subcategory, name) to the matching catalog id, case-insensitively.
+
+    Otherwise exact, like the migration in database.py: the collation's
+    trailing-space and accent folding only narrows the candidates.
+    """
+    if not keys:
+        return {}
+    conditions = ' OR '.join(['(category = %s AND subcategory = %s AND name = %s)'] * len(keys))
+    db_cursor.execute(
+        f'SELECT MIN(id), ANY_VALUE(LOWER(category)), ANY_VALUE(LOWER(subcategory)), ANY_VALUE(LOWER(name)) '
+        f'FROM test_catalog WHERE {conditions} '
+        f'GROUP BY CAST(LOWER(category) AS BINARY), CAST(LOWER(subcategory) AS BINARY), CAST(LOWER(name) AS BINARY)',
+        [value for key in keys for value in key]
+    )
+    return {tuple(row[1:]): row[0] for row in db_cursor.fetchall()}
+
+
+def resolve_references(db_cursor, specs):
+    """Return {spec: (catalog_id, reference_id)} for (category, subcategory, name, normal_range, unit) specs.
+
+    Creates the snapshots that don't exist yet, in the caller's transaction.
+    """
+    specs = list(dict.fromkeys(specs))
+    if not specs:
+        return {}
+    catalog = _catalog_ids(db_cursor, list(dict.fromkeys(spec[:3] for spec in specs)))
+    wanted = {}
+    for spec in specs:
+        catalog_id = catalog.get(tuple(str(part).lower() for part in spec[:3]))
+        wanted[spec] = (catalog_id, _digest(catalog_id, *spec))
+
+    placeholders = ', '.join(['%s'] * len(wanted))
+    hashes = [content_hash for _, content_hash in wanted.values()]
+    db_cursor.execute(f'SELECT content_hash, id FROM test_references WHERE content_hash IN ({placeholders})', hashes)
+    found = dict(db_cursor.fetchall())
+    for spec, (catalog_id, content_hash) in wanted.items():
+        if content_hash in found:
+            continue
+        category, subcategory, name, normal_range, unit = spec
+        # Each new snapshot of a catalog entry is its next version; the
+        # duplicate-key clause makes a concurrent insert of the same one return its id
+        db_cursor.execute('''
+            INSERT INTO test_references
+                (catalog_id, version, category, subcategory, name, reference_range, unit, content_hash)
+            SELECT %s, COALESCE(MAX(version), 0) + 1, %s, %s, %s, %s, %s, %s
+            FROM test_references WHERE catalog_id <=> %s
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+        ''', (catalog_id, category, subcategory, name, normal_range, unit, content_hash, catalog_id))
+        found[content_hash] = db_cursor.lastrowid
+    return {spec: (catalog_id, found[content_hash]) for spec, (catalog_id, content_hash) in wanted.items()}
+
+
+def resolve_notes(db_cursor, notes):
+    """Return {note: note_id} for the non-empty notes, creating missing ones in the caller's transaction."""
+    notes = [note for note in dict.fromkeys(notes) if note]
+    if not notes:
+        return {}
+    hashes = {note: _digest(note) for note in notes}
+    db_cursor.executemany(
+        'INSERT IGNORE INTO test_notes (note, note_hash) VALUES (%s, %s)',
+        list(hashes.items())
+    )
+    placeholders = ', '.join(['%s'] * len(hashes))
+    db_cursor.execute(f'SELECT note_hash, id FROM test_notes WHERE note_hash IN ({placeholders})', list(hashes.values()))
+    ids = dict(db_cursor.fetchall())
+    return {note: ids[content_hash] for note, content_hash in hashes.items()}
+
+
+def result_rows(db_cursor, results):
+    """Turn result dicts into INSERT_RESULT_COLUMNS tuples, resolving their snapshots and notes.
+
+    Each dict has patient_id, category, subcategory, name, value,
+    normal_range, unit, test_date and note.
+    """
+    specs = [
+        (result['category'], result['subcategory'], result['name'], result['normal_range'], result['unit'])
+        for result in results
+    ]
+    references = resolve_references(db_cursor, specs)
+    notes = resolve_notes(db_cursor, [result['note'] for result in results])
+    return [
+        (result['patient_id'], *references[spec], notes.get(result['note']), result['value'], result['test_date'])
+        for result, spec in zip(results, specs)
+    ]
@@ -0,0 +1,65 @@
+"""Declarative mapping from cursor rows to response dicts.
+
+A RowMapper lists the output fields once:
+
+    PATIENT_ROW = RowMapper([
+        ('id', 'id'),
+        ('fullName', 'full_name'),
+        ('refBy', 'ref_by', lambda value: value or ''),
+    ])
+
+and compiles them, per column layout, into a function whose body is a single
+dict display over fixed row positions, e.g.
+``lambda row: {'id': row[0], 'fullName': row[1], 'refBy': _c2(row[8])}``.
+Each row then becomes its output dict in one step, with no intermediate
+column-name dict and no per-field lookups.
+"""
+
+
+def cursor_columns(db_cursor):
+    return tuple(desc[0] for desc in db_cursor.description)
+
+
+class RowMapper:
+    """Projects tuple rows (or dict rows) onto output keys, with optional per-field converters."""
+
+    __slots__ = ('keys', 'columns', 'converters', '_plans', '_dict_project')
+
+    def __init__(self, fields):
+        self.keys = tuple(field[0] for field in fields)
+        self.columns = tuple(field[1] for field in fields)
+        self.converters = {position: field[2] for position, field in enumerate(fields) if len(field) > 2}
+        self._plans = {}
+        # Dict rows are indexed by column name instead of position
+        self._dict_project = self._compile(self.columns)
+
+    def _compile(self, positions):
+        namespace = {f'_c{position}': convert for position, convert in self.converters.items()}
+        items = []
+        for position, (key, index) in enumerate(zip(self.keys, positions)):
+            value = f'row[{index!r}]'
+            if position in self.converters:
+                value = f'_c{position}({value})'
+            items.append(f'{key!r}: {value}')
+        return eval(f"lambda row: {{{', '.join(items)}}}", namespace)
+
+    def _plan(self, columns):
+        project = self._plans.get(columns)
+        if project is None:
+            index = {name: position for position, name in enumerate(columns)}
+            missing = [column for column in self.columns if column not in index]
+            if missing:
+                raise KeyError(f"Query result is missing columns: {', '.join(missing)}")
+            project = self._plans[columns] = self._compile([index[column] for column in self.columns])
+        return project
+
+    def map_rows(self, columns, rows):
+        """Map tuple rows whose layout is given by columns (see cursor_columns)."""
+        return list(map(self._plan(tuple(columns)), rows))
+
+    def map_row(self, columns, row):
+        return self._plan(tuple(columns))(row)
+
+    def map_dicts(self, rows):
+        """Map rows from a dictionary cursor."""
+        return list(map(self._dict_project, rows))
@@ -1,19 +1,44 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response, send_file, stream_with_context
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import re
 import bcrypt
 import jwt
 import os
+import time
+import mysql.connector
 from functools import wraps
 from dotenv import load_dotenv
 
 # Import DB helpers from database.py
-from database import get_db_connection, init_db, init_user_table
+from database import (DEFAULT_LAB_ID, current_lab, execute_statement, get_db_connection, get_directory_connection,
+                      close_leaked_connections, hot_statement, init_db, init_user_table, pool_status,
+                      replica_status, reset_lab, reset_route, route_reads, shard_for_lab, stop_tracking_connections,
+                      track_request_connections, use_lab)
+from importer import CHUNK_SIZE, iter_rows, run_import
+from exporter import FORMATS, export_filename, iter_export
+from archive import ARCHIVE_AFTER_DAYS, archived_before, run_archive
+from reports import REPORT_PREGENERATE, build_report, enqueue_report, load_report_artifact
+from serialization import PATIENT_ROW, group_test_categories, init_serialization, project_fields
+from rowmap import cursor_columns
+from cache_bus import CachedQuery, execute_write, query_cache_stats
+from events import get_broker, stream_events
+from sync import changes_since, parse_cursor, record_deletes
+from singleflight import flights, shared
+from report_views import record_view, view_stats
+from admission import admission_stats, init_admission, route_class
+from results import ARCHIVED_RESULT_LISTING, INSERT_RESULT_COLUMNS, RESULT_LISTING, result_rows
+from purge import DELETED_PATIENT_IDS, list_purge_jobs, soft_delete_patient, start_purger, wake_purger
+from profiling import (PROFILE_HEADER, list_profiles, profile_path, profile_requested, run_profiled, save_profile,
+                       top_functions)
 
 load_dotenv()
 
 app = Flask(__name__)
+init_serialization(app)
+init_admission(app)
+# Starts on the first request and resumes purges a previous process left unfinished
+app.before_request(start_purger)
 
 CORS(app, 
      resources={r"/api/*": {
@@ -25,10 +50,69 @@ CORS(app,
      }},
      supports_credentials=True)
 
+# Connections a handler leaves open (early returns, exceptions) are closed
+# when the request ends, or when the response closes if it is streamed
+@app.before_request
+def track_connections():
+    g.connections = track_request_connections()
+
+@app.after_request
+def close_connections_with_stream(response):
+    if response.is_streamed and 'connections' in g:
+        connections = g.pop('connections')
+        endpoint = request.endpoint
+        response.call_on_close(lambda: report_leaks(connections, endpoint))
+    return response
+
+@app.teardown_request
+def close_connections(error=None):
+    stop_tracking_connections()
+    connections = g.pop('connections', None)
+    if connections is not None:
+        report_leaks(connections, request.endpoint)
+
+def report_leaks(connections, endpoint):
+    leaked = close_leaked_connections(connections)
+    if leaked:
+        print(f"Closed {leaked} connection(s) left open by {endpoint}")
+
+# Reads served from each worker's query cache; writes made with execute_write()
+# invalidate them by table in every worker
+LAB_INFO_QUERY = CachedQuery('SELECT * FROM lab_info WHERE id = %s', ['lab_info'], one=True, directory=True)
+REF_DOCTORS_QUERY = CachedQuery('SELECT * FROM ref_doctors ORDER BY name ASC', ['ref_doctors'])
+PROFILE_QUERY = CachedQuery('SELECT email, full_name, phone, role FROM users WHERE id = %s', ['users'],
+                            one=True, directory=True)
+CATEGORIES_QUERY = CachedQuery('''
+    SELECT id, name, category, subcategory, reference_range, unit, price
+    FROM test_catalog
+''', ['test_catalog'], shape=group_test_categories)
+# Views are tracked constantly and soft deletes don't touch reports, so a
+# short TTL bounds how stale the count can get
+REPORTS_COUNT_QUERY = CachedQuery(f'''
+    SELECT (SELECT COUNT(*) FROM reports WHERE patient_id NOT IN ({DELETED_PATIENT_IDS}))
+         + (SELECT COUNT(*) FROM reports_archive WHERE patient_id NOT IN ({DELETED_PATIENT_IDS})) as count
+''', ['reports', 'reports_archive'], ttl=10, one=True)
+
+# Hot statements, run as server-side prepared statements on pooled connections
+LOGIN_QUERY = hot_statement('login_user', 'SELECT id, password, lab_id FROM users WHERE email = %s')
+INSERT_TEST_RESULT = hot_statement(
+    'insert_test_result',
+    f'INSERT INTO tests {INSERT_RESULT_COLUMNS} VALUES (%s, %s, %s, %s, %s, %s)'
+)
+
 SECRET_KEY = os.getenv('JWT_SECRET_KEY')
 if not SECRET_KEY:
     raise ValueError("No JWT_SECRET_KEY set in environment variables")
 
+# After a successful write the client reads from the primary for this long,
+# so it never sees a replica that hasn't caught up with its own change yet.
+PRIMARY_PIN_SECONDS = int(os.getenv('PRIMARY_PIN_SECONDS', '10'))
+PRIMARY_PIN_COOKIE = 'primary_until'
+
+def token_lab_id(payload):
+    # Tokens issued before multi-lab support belong to the default lab
+    return payload.get('lab_id', DEFAULT_LAB_ID)
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -45,11 +129,86 @@ def token_required(f):
             return jsonify({'error': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'error': 'Invalid token'}), 401
+
+        # Every query in the request goes to the shard of the lab the user belongs to
+        lab_id = token_lab_id(payload)
+        try:
+            shard_for_lab(lab_id)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 403
+
+        # Admins can profile any single request with X-Profile: 1 or ?_profile=1
+        profile_wanted = profile_requested(request)
+        if profile_wanted:
+            try:
+                if not user_is_admin(payload['user_id']):
+                    return jsonify({'error': 'Admin access required to profile requests'}), 403
+            except Exception as e:
+                return jsonify({'error': str(e)}), 500
+
+        # GET requests may read from a replica unless this client wrote recently
+        pinned_until = request.cookies.get(PRIMARY_PIN_COOKIE, default=0.0, type=float)
+        lab = use_lab(lab_id)
+        route = route_reads(request.method == 'GET' and pinned_until < time.time())
+        profile = None
+        try:
+            if profile_wanted:
+                rv, profile = run_profiled(f, *args, **kwargs)
+            else:
+                rv = f(*args, **kwargs)
+        finally:
+            reset_route(route)
+            reset_lab(lab)
+        if request.method == 'GET' and not profile_wanted:
+            return rv
+        response = make_response(rv)
+        if profile_wanted:
+            attach_profile(response, profile)
+        if request.method != 'GET' and response.status_code < 400:
+            response.set_cookie(PRIMARY_PIN_COOKIE, str(time.time() + PRIMARY_PIN_SECONDS),
+                                max_age=PRIMARY_PIN_SECONDS, httponly=True, samesite='Lax')
+        return response
+    return decorated
+
+def attach_profile(response, profile):
+    if profile is None:
+        # Another request holds the profiler; this one ran unprofiled
+        response.headers[PROFILE_HEADER] = 'busy'
+        return
+    profiler, summary = profile
+    response.headers['Server-Timing'] = (f"db;dur={summary['dbMs']}, app;dur={summary['appMs']}, "
+                                         f"total;dur={summary['totalMs']}")
+    summary.update(method=request.method, path=request.full_path.rstrip('?'), endpoint=request.endpoint,
+                   status=response.status_code, userId=request.user['user_id'])
+    try:
+        response.headers['X-Profile-Id'] = save_profile(profiler, summary)
+    except OSError as e:
+        print(f"Error saving profile: {str(e)}")
+
+def user_is_admin(user_id):
+    conn = get_directory_connection()
+    db_cursor = conn.cursor()
+    db_cursor.execute('SELECT role FROM users WHERE id = %s', (user_id,))
+    user = db_cursor.fetchone()
+    conn.close()
+    return bool(user) and user[0] == 'admin'
+
+def admin_required(f):
+    # Use below @token_required; request.user is set by then
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            is_admin = user_is_admin(request.user['user_id'])
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        if not is_admin:
+            return jsonify({'error': 'Admin access required'}), 403
         return f(*args, **kwargs)
     return decorated
 
 
 @app.route('/api/init-db', methods=['POST'])
+@route_class('admin')
 def initialize_database():
     try:
         init_db()
@@ -70,30 +229,14 @@ def get_patients():
         db_cursor = conn.cursor()
         
         # Execute query to get all patients
-        db_cursor.execute('SELECT * FROM patients ORDER BY created_at DESC')
+        db_cursor.execute('SELECT * FROM patients WHERE deleted_at IS NULL ORDER BY created_at DESC')
         patients = db_cursor.fetchall()  
         conn.close()
         
         # Convert to list of dictionaries
-        patient_list = []
-        # Using db_cursor.column_names to map tuples to dicts for consistency
-        columns = [desc[0] for desc in db_cursor.description]
-        for patient_row in patients:
-            patient_dict = dict(zip(columns, patient_row))
-            patient_list.append({
-                'id': patient_dict['id'],
-                'fullName': patient_dict['full_name'],
-                'age': patient_dict['age'],
-                'gender': patient_dict['gender'],
-                'contactNumber': patient_dict['contact_number'],
-                'email': patient_dict['email'],
-                'patientCode': patient_dict['patient_code'],
-                'address': patient_dict['address'],
-                'refBy': patient_dict['ref_by'] or '',
-                'createdAt': patient_dict['created_at']
-            })
+        patient_list = PATIENT_ROW.map_rows(cursor_columns(db_cursor), patients)
         
-        return jsonify(patient_list)
+        return jsonify(project_fields(patient_list))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -126,8 +269,14 @@ def add_patient():
             data['address'],
             data.get('refBy', '')  # Optional field
         ))
+        patient_id = db_cursor.lastrowid
         conn.commit()
         conn.close()
+        get_broker().publish('new-patient', {
+            'id': patient_id,
+            'fullName': data['fullName'],
+            'patientCode': data['patientCode']
+        }, totalPatients=1)
         return jsonify({'message': 'Patient added successfully'}), 201
     except mysql.connector.IntegrityError as e:
         if "Duplicate entry" in str(e) and "patient_code" in str(e):
@@ -152,7 +301,7 @@ def update_patient(patient_id):
         db_cursor = conn.cursor()
         
         # Check if patient exists
-        db_cursor.execute('SELECT id FROM patients WHERE id = %s', (patient_id,))
+        db_cursor.execute('SELECT id FROM patients WHERE id = %s AND deleted_at IS NULL', (patient_id,))
         if not db_cursor.fetchone():
             conn.close()
             return jsonify({'error': 'Patient not found'}), 404
@@ -173,8 +322,11 @@ def update_patient(patient_id):
             data.get('refBy', ''),
             patient_id
         ))
+        # Patient details are part of the stored report, so drop it and rebuild
+        db_cursor.execute('DELETE FROM report_artifacts WHERE patient_id = %s', (patient_id,))
         conn.commit()
         conn.close()
+        enqueue_report(patient_id)
         return jsonify({'message': 'Patient updated successfully'}), 200
     except mysql.connector.IntegrityError as e:
         if "Duplicate entry" in str(e) and "patient_code" in str(e):
@@ -191,17 +343,24 @@ def delete_patient(patient_id):
         db_cursor = conn.cursor()
         
         # Check if patient exists
-        db_cursor.execute('SELECT id FROM patients WHERE id = %s', (patient_id,))
+        db_cursor.execute('SELECT id FROM patients WHERE id = %s AND deleted_at IS NULL', (patient_id,))
         if not db_cursor.fetchone():
             conn.close()
             return jsonify({'error': 'Patient not found'}), 404
         
-        # Delete patient
-        db_cursor.execute('DELETE FROM patients WHERE id = %s', (patient_id,))
+        # Results go with the patient, so tombstone them too
+        db_cursor.execute('SELECT id FROM tests WHERE patient_id = %s', (patient_id,))
+        record_deletes(db_cursor, 'tests', [row[0] for row in db_cursor.fetchall()])
+        record_deletes(db_cursor, 'patients', [patient_id])
+
+        # Hide the patient now; purge.py removes its rows in small batches afterwards
+        job_id = soft_delete_patient(db_cursor, patient_id)
         conn.commit()
         conn.close()
+        wake_purger()
+        get_broker().refresh('patient-deleted', {'id': patient_id})
         
-        return jsonify({'message': 'Patient deleted successfully'}), 200
+        return jsonify({'message': 'Patient deleted successfully', 'purgeJobId': job_id}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -210,11 +369,16 @@ def delete_patient(patient_id):
 def get_tests():
     try:
         conn = get_db_connection()
+        live = f't.patient_id NOT IN ({DELETED_PATIENT_IDS})'
+        sql = f'{RESULT_LISTING} WHERE {live}'
+        # Once the archiver has run, older results live in tests_archive
+        if archived_before(conn.cursor(), 'tests') is not None:
+            sql += f' UNION ALL {ARCHIVED_RESULT_LISTING} WHERE {live}'
         db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
-        db_cursor.execute('SELECT * FROM tests ORDER BY created_at DESC')
+        db_cursor.execute(sql + ' ORDER BY created_at DESC')
         tests = db_cursor.fetchall()
         conn.close()
-        return jsonify(tests)
+        return jsonify(project_fields(tests))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -231,7 +395,7 @@ def add_test():
         conn = get_db_connection()
         db_cursor = conn.cursor()
         
-        db_cursor.execute('''
+        execute_write(db_cursor, '''
             INSERT INTO test_catalog (name, category, subcategory, reference_range, unit, price)
             VALUES (%s, %s, %s, %s, %s, %s)
         ''', (
@@ -265,39 +429,34 @@ def add_test_results():
 
         conn = get_db_connection()
         db_cursor = conn.cursor()
+
+        db_cursor.execute('SELECT id FROM patients WHERE id = %s AND deleted_at IS NULL', (data['patientId'],))
+        if not db_cursor.fetchone():
+            conn.close()
+            return jsonify({'error': 'Patient not found'}), 404
         
         # Get test date from request or use current timestamp
         test_date = data.get('testDate', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         
         # Insert each test result
-        for test in data['tests']:
-            db_cursor.execute('''
-                INSERT INTO tests (
-                    patient_id, 
-                    test_category, 
-                    test_subcategory,
-                    test_name, 
-                    test_value, 
-                    normal_range, 
-                    unit, 
-                    test_date,
-                    additional_note
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                data['patientId'],
-                data['category'],
-                data['subcategory'],
-                test['testName'],
-                test['value'],
-                test.get('normalRange'),
-                test.get('unit'),
-                test_date,
-                data.get('notes')
-            ))
+        rows = result_rows(db_cursor, [{
+            'patient_id': data['patientId'],
+            'category': data['category'],
+            'subcategory': data['subcategory'],
+            'name': test['testName'],
+            'value': test['value'],
+            'normal_range': test.get('normalRange'),
+            'unit': test.get('unit'),
+            'test_date': test_date,
+            'note': data.get('notes')
+        } for test in data['tests']])
+        for row in rows:
+            execute_statement(conn, INSERT_TEST_RESULT, row)
         
         conn.commit()
         conn.close()
+        enqueue_report(data['patientId'])
+        publish_new_results(data['patientId'], [test['testName'] for test in data['tests']], test_date)
         
         return jsonify({'message': 'Test results added successfully'}), 201
     except Exception as e:
@@ -325,7 +484,7 @@ def update_test(test_id):
             return jsonify({'error': 'Test not found'}), 404
         
         # Update test
-        db_cursor.execute('''
+        execute_write(db_cursor, '''
             UPDATE test_catalog 
             SET name = %s, category = %s, subcategory = %s, reference_range = %s, unit = %s, price = %s
             WHERE id = %s
@@ -361,19 +520,34 @@ def delete_test(test_id):
         if not db_cursor.fetchone():
             conn.close()
             return jsonify({'error': 'Test not found'}), 404
-        
+
+        # Results keep pointing at their catalog entry; the foreign key on tests
+        # also refuses, but archived results have none
+        db_cursor.execute('''
+            SELECT EXISTS(SELECT 1 FROM tests WHERE catalog_id = %s)
+                OR EXISTS(SELECT 1 FROM tests_archive WHERE catalog_id = %s)
+        ''', (test_id, test_id))
+        if db_cursor.fetchone()[0]:
+            conn.close()
+            return jsonify({'error': 'Test has recorded results and cannot be deleted'}), 409
+
         # Delete test
-        db_cursor.execute('DELETE FROM test_catalog WHERE id = %s', (test_id,))
+        execute_write(db_cursor, 'DELETE FROM test_catalog WHERE id = %s', (test_id,))
+        record_deletes(db_cursor, 'test_catalog', [test_id])
         conn.commit()
         conn.close()
         return jsonify({'message': 'Test deleted successfully'}), 200
+    except mysql.connector.IntegrityError:
+        # A result for this test was saved after the check
+        conn.close()
+        return jsonify({'error': 'Test has recorded results and cannot be deleted'}), 409
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/labs', methods=['GET'])
 def get_labs():
     try:
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
         db_cursor.execute('SELECT * FROM lab_info ORDER BY created_at DESC')
         lab_info = db_cursor.fetchall()
@@ -383,6 +557,7 @@ def get_labs():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/labs', methods=['POST'])
+@route_class('admin')
 def add_lab():
     data = request.json
     required_fields = ['name', 'address', 'phone', 'email']
@@ -390,9 +565,9 @@ def add_lab():
         if field not in data:
             return jsonify({'error': f'Missing required field: {field}'}), 400
     try:
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
-        db_cursor.execute('''
+        lab_id = execute_write(db_cursor, '''
             INSERT INTO lab_info (name, address, phone, email)
             VALUES (%s, %s, %s, %s)
         ''', (
@@ -400,10 +575,11 @@ def add_lab():
             data['address'],
             data['phone'],
             data['email']
-        ))
+        )).lastrowid
         conn.commit()
         conn.close()
-        return jsonify({'message': 'Lab added successfully'}), 201
+        # The lab's data goes to the shard mapped to this id in LAB_SHARDS
+        return jsonify({'message': 'Lab added successfully', 'id': lab_id}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -415,102 +591,25 @@ def generate_report(patient_id):
         end = request.args.get('end')
         print(f"Received start: {start}, end: {end}")  # Log received dates
 
-        conn = get_db_connection()
-        db_cursor = conn.cursor()
-
-        # Get patient information
-        db_cursor.execute('SELECT * FROM patients WHERE id = %s', (patient_id,))
-        patient_row = db_cursor.fetchone()
-        if not patient_row:
+        def load_report():
+            conn = get_db_connection()
+            db_cursor = conn.cursor()
+            try:
+                # Serve the pre-generated full report when it is still current
+                if REPORT_PREGENERATE and not (start and end):
+                    report = load_report_artifact(db_cursor, patient_id)
+                    if report is not None:
+                        return report
+                    enqueue_report(patient_id)
+                return build_report(conn, patient_id, start, end)
+            finally:
+                conn.close()
+
+        # Staff opening the same report at once share one build
+        report = shared('report', (patient_id, start, end), load_report)
+        if report is None:
             return jsonify({'error': 'Patient not found'}), 404
-
-        patient_columns = [desc[0] for desc in db_cursor.description]
-        patient = dict(zip(patient_columns, patient_row))
-
-        # Fetch tests for the patient, filtered by test_date if start and end are provided
-        if start and end:
-            db_cursor.execute('''
-                SELECT * FROM tests 
-                WHERE patient_id = %s 
-                  AND DATE(test_date) BETWEEN %s AND %s
-                ORDER BY test_category, test_subcategory, test_date DESC
-            ''', (patient_id, start, end))
-        else:
-            db_cursor.execute('''
-                SELECT * FROM tests 
-                WHERE patient_id = %s 
-                ORDER BY test_category, test_subcategory, test_date DESC
-            ''', (patient_id,))
-        tests_rows = db_cursor.fetchall()
-        test_columns = [desc[0] for desc in db_cursor.description]
-        conn.close()
-
-        # Print all test dates and names
-        print("Fetched tests:")
-        for test_row in tests_rows:
-            test = dict(zip(test_columns, test_row))
-            print(f"Test: {test['test_name']}, Date: {test['test_date']}")
-
-        # Convert tests to list of dictionaries and calculate status
-        test_list = []
-        for test_row in tests_rows:
-            test = dict(zip(test_columns, test_row))
-            value = test['test_value']
-            ref_range = str(test['normal_range'])
-            status = 'Normal'
-            ref = ref_range.replace('–', '-').replace(' ', '')
-            match = re.match(r'^(\d+(?:\.\d+)?)-(\d+(?:\.\d+)?)$', ref)
-            if match:
-                low, high = float(match.group(1)), float(match.group(2))
-                if float(value) < low:
-                    status = 'Low'
-                elif float(value) > high:
-                    status = 'High'
-            elif ref.startswith('<'):
-                try:
-                    high = float(ref[1:])
-                    if float(value) >= high:
-                        status = 'High'
-                except:
-                    pass
-            elif ref.lower().startswith('upto') or ref.lower().startswith('up to'):
-                try:
-                    high = float(re.findall(r'\d+(?:\.\d+)?', ref)[0])
-                    if float(value) > high:
-                        status = 'High'
-                except:
-                    pass
-            elif ref.lower() == 'positive':
-                if str(value).lower() != 'positive':
-                    status = 'Abnormal'
-            elif ref.lower() == 'negative':
-                if str(value).lower() != 'negative':
-                    status = 'Abnormal'
-
-            test_list.append({
-                'id': test['id'],
-                'testCategory': test['test_category'],
-                'testSubcategory': test['test_subcategory'],
-                'testName': test['test_name'],
-                'testValue': value,
-                'normalRange': test['normal_range'],
-                'unit': test['unit'],
-                'additionalNote': test['additional_note'],
-                'testDate': test['test_date'].strftime('%Y-%m-%d %H:%M:%S') if test['test_date'] else None,
-                'status': status
-            })
-
-        report = {
-            'patientName': patient['full_name'],
-            'patientCode': patient['patient_code'],
-            'patientAge': patient['age'],
-            'patientGender': patient['gender'],
-            'contactNumber': patient['contact_number'],
-            'refBy': patient['ref_by'],
-            'tests': test_list
-        }
-
-        return jsonify(report)
+        return jsonify(project_fields(report))
     except Exception as e:
         print(f"Error generating report: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -531,11 +630,10 @@ def login():
         if not email or not password:
             return jsonify({'error': 'Missing email or password'}), 400
         
-        conn = get_db_connection()
-        db_cursor = conn.cursor()
-        db_cursor.execute('SELECT id, password FROM users WHERE email = %s', (email,))
-        user = db_cursor.fetchone()
+        conn = get_directory_connection()
+        users = execute_statement(conn, LOGIN_QUERY, (email,)).fetchall()
         conn.close()
+        user = users[0] if users else None
         
         if not user:
             return jsonify({'error': 'Invalid email address'}), 401
@@ -547,6 +645,7 @@ def login():
         payload = {
             'user_id': user[0],
             'email': email,
+            'lab_id': user[2],
             'exp': datetime.utcnow() + timedelta(days=1)
         }
         token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
@@ -571,7 +670,7 @@ def update_admin_credentials():
         if not new_email or not new_password or not current_password:
             return jsonify({'error': 'Missing required fields'}), 400
             
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
         
         # Verify current password
@@ -584,8 +683,8 @@ def update_admin_credentials():
             
         # Update credentials
         hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        db_cursor.execute('UPDATE users SET email = %s, password = %s WHERE email = %s',
-                         (new_email, hashed_password.decode('utf-8'), request.user['email']))
+        execute_write(db_cursor, 'UPDATE users SET email = %s, password = %s WHERE email = %s',
+                      (new_email, hashed_password.decode('utf-8'), request.user['email']))
         conn.commit()
         conn.close()
         
@@ -602,58 +701,51 @@ def track_report():
         data = request.json
         if not data or 'patientId' not in data:
             return jsonify({'error': 'Patient ID is required'}), 400
+        # A bad id would only fail later, in the flusher's batch insert
+        if not isinstance(data['patientId'], int) or isinstance(data['patientId'], bool):
+            return jsonify({'error': 'Patient ID must be an integer'}), 400
 
-        conn = get_db_connection()
-        db_cursor = conn.cursor()
-        
-        # Insert report record
-        db_cursor.execute('''
-            INSERT INTO reports (patient_id)
-            VALUES (%s)
-        ''', (data['patientId'],))
-        
-        conn.commit()
-        conn.close()
+        # Buffered and written in batches by report_views.py, off the request path
+        record_view(data['patientId'])
+        get_broker().publish('new-report', {'patientId': data['patientId']}, reportsGenerated=1)
         
         return jsonify({'message': 'Report tracked successfully'}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/reports/count', methods=['GET'])
+@route_class('background')
 @token_required
 def get_reports_count():
     try:
-        conn = get_db_connection()
-        db_cursor = conn.cursor()
-        
-        # Get total reports count
-        db_cursor.execute('SELECT COUNT(*) as count FROM reports')
-        result = db_cursor.fetchone()
-        conn.close()
-        
-        return jsonify({'count': result[0]}) # Access by index
+        # Total reports count, including views moved to the archive
+        return jsonify(shared('reports-count', (), REPORTS_COUNT_QUERY.fetch))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/reports/recent', methods=['GET'])
+@route_class('background')
 @token_required
 def get_recent_reports():
     try:
-        conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
-        
-        # Get recent reports with patient names
-        db_cursor.execute('''
-            SELECT r.*, p.full_name as patient_name
-            FROM reports r
-            JOIN patients p ON r.patient_id = p.id
-            ORDER BY r.generated_at DESC
-            LIMIT 10
-        ''')
-        reports = db_cursor.fetchall()
-        conn.close()
-        
-        return jsonify(reports)
+        def load_recent():
+            conn = get_db_connection()
+            db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
+
+            # Get recent reports with patient names
+            db_cursor.execute('''
+                SELECT r.*, p.full_name as patient_name
+                FROM reports r
+                JOIN patients p ON r.patient_id = p.id
+                WHERE p.deleted_at IS NULL
+                ORDER BY r.generated_at DESC
+                LIMIT 10
+            ''')
+            reports = db_cursor.fetchall()
+            conn.close()
+            return reports
+
+        return jsonify(shared('reports-recent', (), load_recent))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -661,11 +753,7 @@ def get_recent_reports():
 @token_required
 def get_lab_info():
     try:
-        conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True)
-        db_cursor.execute('SELECT * FROM lab_info WHERE id = 1')
-        lab_info = db_cursor.fetchone()
-        conn.close()
+        lab_info = LAB_INFO_QUERY.fetch(current_lab())
         if lab_info:
             return jsonify(lab_info)
         return jsonify({'error': 'Lab info not found'}), 404
@@ -681,12 +769,14 @@ def add_lab_info():
         if field not in data:
             return jsonify({'error': f'Missing required field: {field}'}), 400
     try:
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
-        db_cursor.execute('''
-            INSERT INTO lab_info (name, address, phone, email)
-            VALUES (%s, %s, %s, %s)
+        # The registry row doubles as the lab's details, keyed by the caller's lab
+        execute_write(db_cursor, '''
+            INSERT INTO lab_info (id, name, address, phone, email)
+            VALUES (%s, %s, %s, %s, %s)
         ''', (
+            current_lab(),
             data['name'],
             data['address'],
             data['phone'],
@@ -707,17 +797,18 @@ def update_lab_info():
         if field not in data:
             return jsonify({'error': f'Missing required field: {field}'}), 400
     try:
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
-        db_cursor.execute('''
+        execute_write(db_cursor, '''
             UPDATE lab_info 
             SET name = %s, address = %s, phone = %s, email = %s
-            WHERE id = 1
+            WHERE id = %s
         ''', (
             data['name'],
             data['address'],
             data['phone'],
-            data['email']
+            data['email'],
+            current_lab()
         ))
         conn.commit()
         conn.close()
@@ -729,12 +820,7 @@ def update_lab_info():
 @token_required
 def get_ref_doctors():
     try:
-        conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
-        db_cursor.execute('SELECT * FROM ref_doctors ORDER BY name ASC')
-        doctors = db_cursor.fetchall()
-        conn.close()
-        return jsonify(doctors)
+        return jsonify(REF_DOCTORS_QUERY.fetch())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -748,7 +834,7 @@ def add_ref_doctor():
         
         conn = get_db_connection()
         db_cursor = conn.cursor()
-        db_cursor.execute('''
+        execute_write(db_cursor, '''
             INSERT INTO ref_doctors (name, specialization)
             VALUES (%s, %s)
         ''', (data['name'], data.get('specialization')))
@@ -780,7 +866,7 @@ def update_ref_doctor(doctor_id):
             conn.close()
             return jsonify({'error': 'Reference doctor not found'}), 404
         
-        db_cursor.execute('''
+        execute_write(db_cursor, '''
             UPDATE ref_doctors 
             SET name = %s, specialization = %s
             WHERE id = %s
@@ -809,7 +895,8 @@ def delete_ref_doctor(doctor_id):
             conn.close()
             return jsonify({'error': 'Reference doctor not found'}), 404
         
-        db_cursor.execute('DELETE FROM ref_doctors WHERE id = %s', (doctor_id,))
+        execute_write(db_cursor, 'DELETE FROM ref_doctors WHERE id = %s', (doctor_id,))
+        record_deletes(db_cursor, 'ref_doctors', [doctor_id])
         conn.commit()
         conn.close()
         return jsonify({'message': 'Reference doctor deleted successfully'}), 200
@@ -820,91 +907,249 @@ def delete_ref_doctor(doctor_id):
 @token_required
 def get_test_categories():
     try:
-        conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
-
-        # Get all tests without grouping or JSON functions
-        db_cursor.execute('''
-            SELECT id, name, category, subcategory, reference_range, unit, price
-            FROM test_catalog
-        ''')
-
-        all_tests = db_cursor.fetchall()
-        conn.close()
-
-        # Group by category first, then subcategory in Python
-        result = {}
-        for test in all_tests:
-            category = test['category']
-            subcategory = test['subcategory']
-
-            if category not in result:
-                result[category] = {
-                    'category': category,
-                    'subcategories': []
-                }
-
-            # Find existing subcategory or create a new one
-            found_subcategory = None
-            for sub_item in result[category]['subcategories']:
-                if sub_item['subcategory'] == subcategory:
-                    found_subcategory = sub_item
-                    break
-            
-            if not found_subcategory:
-                found_subcategory = {
-                    'subcategory': subcategory,
-                    'tests': []
-                }
-                result[category]['subcategories'].append(found_subcategory)
-            
-            found_subcategory['tests'].append({
-                'id': test['id'],
-                'name': test['name'],
-                'referenceRange': test['reference_range'],
-                'unit': test['unit'],
-                'price': test['price']
-            })
-        
-        # Sort subcategories and tests for consistent order
-        for category_data in result.values():
-            category_data['subcategories'].sort(key=lambda x: x['subcategory'])
-            for subcategory_data in category_data['subcategories']:
-                subcategory_data['tests'].sort(key=lambda x: x['name'])
-
-        return jsonify(list(result.values()))
+        return jsonify(shared('categories', (), CATEGORIES_QUERY.fetch))
     except Exception as e:
         print(f"Error fetching test categories: {str(e)}") # Add logging for debugging
         return jsonify({'error': str(e)}), 500
 
+def next_patient_code(latest_code):
+    if latest_code:
+        # Extract number, increment, and format to PAT000001
+        match = re.match(r'PAT(\d+)', latest_code)
+        if match:
+            num = int(match.group(1))
+            new_num = num + 1
+            return f'PAT{new_num:06d}' # Format as PAT000001, PAT000002, etc.
+        return 'PAT000001' # Fallback if format is unexpected
+    return 'PAT000001' # First patient
+
 @app.route('/api/patients/latest-code', methods=['GET'])
 @token_required
 def get_latest_patient_code():
     try:
-        conn = get_db_connection()
+        # The primary: a replica may not have a code just issued to another client yet
+        conn = get_db_connection(read_only=False)
         db_cursor = conn.cursor()
         db_cursor.execute('SELECT patient_code FROM patients ORDER BY id DESC LIMIT 1')
         latest_code_row = db_cursor.fetchone()
         conn.close()
 
-        if latest_code_row and latest_code_row[0]:
-            latest_code = latest_code_row[0]
-            # Extract number, increment, and format to PAT000001
-            match = re.match(r'PAT(\d+)', latest_code)
-            if match:
-                num = int(match.group(1))
-                new_num = num + 1
-                new_code = f'PAT{new_num:06d}' # Format as PAT000001, PAT000002, etc.
-            else:
-                new_code = 'PAT000001' # Fallback if format is unexpected
-        else:
-            new_code = 'PAT000001' # First patient
-
+        new_code = next_patient_code(latest_code_row[0] if latest_code_row else None)
         return jsonify({'code': new_code})
     except Exception as e:
         print(f"Error fetching latest patient code: {str(e)}") # Add logging for debugging
         return jsonify({'error': str(e)}), 500
 
+PATIENT_REQUIRED_FIELDS = ['fullName', 'age', 'gender', 'contactNumber', 'email', 'address']
+MAX_BATCH_REGISTRATIONS = 1000
+
+def registration_panels(entry):
+    # A registration carries either a list of panels or a single flat panel,
+    # the same shape POST /api/test-results accepts.
+    if 'panels' in entry:
+        return entry['panels'] or []
+    if 'tests' in entry:
+        return [entry]
+    return []
+
+def publish_new_results(patient_id, test_names, test_date):
+    today = str(test_date or datetime.now().date())[:10] == datetime.now().strftime('%Y-%m-%d')
+    get_broker().publish('new-result', {
+        'patientId': patient_id,
+        'tests': test_names,
+        'testDate': test_date
+    }, totalTests=len(test_names), testsToday=len(test_names) if today else 0)
+
+def validate_registration(entry):
+    if not isinstance(entry, dict):
+        return 'Invalid registration entry'
+    for field in PATIENT_REQUIRED_FIELDS:
+        if field not in entry:
+            return f'Missing required field: {field}'
+    if 'panels' in entry and not isinstance(entry['panels'], (list, type(None))):
+        return 'panels must be a list'
+    for panel in registration_panels(entry):
+        if not isinstance(panel, dict):
+            return 'Each panel must be an object'
+        for field in ['category', 'subcategory', 'tests']:
+            if field not in panel:
+                return f'Missing required field: {field}'
+        if not isinstance(panel['tests'], list):
+            return 'tests must be a list'
+        for test in panel['tests']:
+            if not isinstance(test, dict) or 'testName' not in test or 'value' not in test:
+                return 'Each test requires testName and value'
+    return None
+
+def register_patients(db_cursor, entries):
+    """Insert patients, their test results and optional report tracking rows.
+
+    Runs on the caller's cursor so everything lands in the caller's transaction.
+    Returns one summary dict per entry, in input order.
+    """
+    # Lock the newest patient row so concurrent registrations can't hand out the same code
+    db_cursor.execute('SELECT patient_code FROM patients ORDER BY id DESC LIMIT 1 FOR UPDATE')
+    latest_code_row = db_cursor.fetchone()
+    latest_code = latest_code_row[0] if latest_code_row else None
+
+    codes = []
+    for entry in entries:
+        code = entry.get('patientCode')
+        if not code:
+            code = next_patient_code(latest_code)
+            latest_code = code
+        codes.append(code)
+
+    db_cursor.executemany('''
+        INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address, ref_by)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ''', [
+        (entry['fullName'], entry['age'], entry['gender'], entry['contactNumber'],
+         entry['email'], code, entry['address'], entry.get('refBy', ''))
+        for entry, code in zip(entries, codes)
+    ])
+
+    placeholders = ', '.join(['%s'] * len(codes))
+    db_cursor.execute(f'SELECT id, patient_code FROM patients WHERE patient_code IN ({placeholders})', codes)
+    ids_by_code = {code: patient_id for patient_id, code in db_cursor.fetchall()}
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    test_rows = []
+    report_rows = []
+    results = []
+    for entry, code in zip(entries, codes):
+        patient_id = ids_by_code[code]
+        tests_added = 0
+        for panel in registration_panels(entry):
+            test_date = panel.get('testDate', now)
+            for test in panel['tests']:
+                test_rows.append({
+                    'patient_id': patient_id,
+                    'category': panel['category'],
+                    'subcategory': panel['subcategory'],
+                    'name': test['testName'],
+                    'value': test['value'],
+                    'normal_range': test.get('normalRange'),
+                    'unit': test.get('unit'),
+                    'test_date': test_date,
+                    'note': panel.get('notes')
+                })
+                tests_added += 1
+        if entry.get('trackReport'):
+            report_rows.append((patient_id,))
+        results.append({
+            'id': patient_id,
+            'fullName': entry['fullName'],
+            'age': entry['age'],
+            'gender': entry['gender'],
+            'contactNumber': entry['contactNumber'],
+            'email': entry['email'],
+            'patientCode': code,
+            'address': entry['address'],
+            'refBy': entry.get('refBy', ''),
+            'testsAdded': tests_added,
+            'reportTracked': bool(entry.get('trackReport'))
+        })
+
+    if test_rows:
+        db_cursor.executemany(INSERT_TEST_RESULT, result_rows(db_cursor, test_rows))
+    if report_rows:
+        execute_write(db_cursor, 'INSERT INTO reports (patient_id) VALUES (%s)', report_rows, many=True)
+
+    return results
+
+@app.route('/api/patients/register', methods=['POST'])
+@token_required
+def register_patient_with_tests():
+    data = request.json
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    error = validate_registration(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        try:
+            patient = register_patients(db_cursor, [data])[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if patient['testsAdded']:
+            enqueue_report(patient['id'])
+        get_broker().publish('new-patient', {
+            'id': patient['id'],
+            'fullName': patient['fullName'],
+            'patientCode': patient['patientCode']
+        }, totalPatients=1)
+        for panel in registration_panels(data):
+            publish_new_results(patient['id'], [test['testName'] for test in panel['tests']], panel.get('testDate'))
+        if patient['reportTracked']:
+            get_broker().publish('new-report', {'patientId': patient['id']}, reportsGenerated=1)
+        return jsonify({'message': 'Patient registered successfully', 'patient': patient}), 201
+    except mysql.connector.IntegrityError as e:
+        if "Duplicate entry" in str(e) and "patient_code" in str(e):
+            return jsonify({'error': 'Patient code already exists'}), 400
+        return jsonify({'error': str(e)}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/patients/batch-register', methods=['POST'])
+@route_class('background')
+@token_required
+def batch_register_patients():
+    data = request.json
+    if not isinstance(data, dict) or not data.get('patients'):
+        return jsonify({'error': 'Missing required field: patients'}), 400
+    entries = data['patients']
+    if not isinstance(entries, list):
+        return jsonify({'error': 'patients must be a list'}), 400
+    if len(entries) > MAX_BATCH_REGISTRATIONS:
+        return jsonify({'error': f'A batch can register at most {MAX_BATCH_REGISTRATIONS} patients'}), 400
+
+    # Validate everything up front so a bad row never leaves a half-written batch
+    errors = []
+    for index, entry in enumerate(entries):
+        error = validate_registration(entry)
+        if error:
+            errors.append({'index': index, 'error': error})
+    if errors:
+        return jsonify({'error': 'Invalid registrations', 'details': errors}), 400
+
+    try:
+        conn = get_db_connection()
+        db_cursor = conn.cursor()
+        try:
+            patients = register_patients(db_cursor, entries)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        for patient in patients:
+            if patient['testsAdded']:
+                enqueue_report(patient['id'])
+        # One summary event rather than hundreds, which would overflow dashboard queues
+        get_broker().refresh('batch-registered', {
+            'patients': len(patients),
+            'testsAdded': sum(patient['testsAdded'] for patient in patients)
+        })
+        return jsonify({
+            'message': f'{len(patients)} patients registered successfully',
+            'patients': patients
+        }), 201
+    except mysql.connector.IntegrityError as e:
+        if "Duplicate entry" in str(e) and "patient_code" in str(e):
+            return jsonify({'error': 'Patient code already exists'}), 400
+        return jsonify({'error': str(e)}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/test-results/<int:test_id>', methods=['DELETE'])
 @token_required
 def delete_test_result(test_id):
@@ -912,16 +1157,23 @@ def delete_test_result(test_id):
         conn = get_db_connection()
         db_cursor = conn.cursor()
         
-        # Check if test result exists
+        # Check if test result exists, in the hot table or the archive
         db_cursor.execute('SELECT id FROM tests WHERE id = %s', (test_id,))
-        if not db_cursor.fetchone():
-            conn.close()
-            return jsonify({'error': 'Test result not found'}), 404
-        
-        # Delete test result
-        db_cursor.execute('DELETE FROM tests WHERE id = %s', (test_id,))
+        if db_cursor.fetchone():
+            db_cursor.execute('DELETE FROM tests WHERE id = %s', (test_id,))
+        else:
+            db_cursor.execute('SELECT patient_id FROM tests_archive WHERE id = %s', (test_id,))
+            archived = db_cursor.fetchone()
+            if not archived:
+                conn.close()
+                return jsonify({'error': 'Test result not found'}), 404
+            db_cursor.execute('DELETE FROM tests_archive WHERE id = %s', (test_id,))
+            # The stored report's fingerprint only covers the hot table, so drop it
+            db_cursor.execute('DELETE FROM report_artifacts WHERE patient_id = %s', (archived[0],))
+        record_deletes(db_cursor, 'tests', [test_id])
         conn.commit()
         conn.close()
+        get_broker().refresh('result-deleted', {'id': test_id})
         return jsonify({'message': 'Test result deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -930,15 +1182,8 @@ def delete_test_result(test_id):
 @token_required
 def get_profile():
     try:
-        conn = get_db_connection()
-        db_cursor = conn.cursor(dictionary=True) # Fetch as dictionary
-        
-        # Get user profile from database using user_id from token
-        db_cursor.execute('SELECT email, full_name, phone, role FROM users WHERE id = %s', 
-                           (request.user['user_id'],))
-        user = db_cursor.fetchone()
-        conn.close()
-        
+        # Get user profile using user_id from token
+        user = PROFILE_QUERY.fetch(request.user['user_id'])
         if user:
             return jsonify({
                 'email': user['email'],
@@ -955,10 +1200,10 @@ def get_profile():
 def update_profile():
     try:
         data = request.json
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
         
-        db_cursor.execute('''
+        execute_write(db_cursor, '''
             UPDATE users 
             SET full_name = %s, phone = %s, role = %s
             WHERE id = %s
@@ -985,7 +1230,7 @@ def change_email():
         if not current_password or not new_email:
             return jsonify({'error': 'Missing current password or new email'}), 400
 
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
         
         # Verify current password
@@ -1003,8 +1248,8 @@ def change_email():
             return jsonify({'error': 'Email already in use'}), 400
             
         # Update email
-        db_cursor.execute('UPDATE users SET email = %s WHERE id = %s',
-                          (new_email, request.user['user_id']))
+        execute_write(db_cursor, 'UPDATE users SET email = %s WHERE id = %s',
+                      (new_email, request.user['user_id']))
         conn.commit()
         conn.close()
         return jsonify({'message': 'Email updated successfully'}), 200
@@ -1022,7 +1267,7 @@ def change_password():
         if not current_password or not new_password:
             return jsonify({'error': 'Missing current password or new password'}), 400
 
-        conn = get_db_connection()
+        conn = get_directory_connection()
         db_cursor = conn.cursor()
         
         # Verify current password
@@ -1035,14 +1280,206 @@ def change_password():
             
         # Update password
         hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        db_cursor.execute('UPDATE users SET password = %s WHERE id = %s',
-                          (hashed_password.decode('utf-8'), request.user['user_id']))
+        execute_write(db_cursor, 'UPDATE users SET password = %s WHERE id = %s',
+                      (hashed_password.decode('utf-8'), request.user['user_id']))
         conn.commit()
         conn.close()
         return jsonify({'message': 'Password updated successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/import/<kind>', methods=['POST'])
+@route_class('background')
+@token_required
+def import_data(kind):
+    if kind not in ('patients', 'results'):
+        return jsonify({'error': 'Import kind must be patients or results'}), 404
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'error': 'Missing required file: file'}), 400
+    try:
+        chunk_size = max(1, min(int(request.args.get('chunkSize', CHUNK_SIZE)), 10000))
+    except ValueError:
+        return jsonify({'error': 'chunkSize must be a number'}), 400
+
+    try:
+        conn = get_db_connection()
+        try:
+            # upload.stream is spooled to disk by Werkzeug, so rows are read incrementally
+            summary = run_import(conn, kind, iter_rows(upload.stream, upload.filename), chunk_size)
+        finally:
+            conn.close()
+        if summary['imported']:
+            get_broker().refresh('import-finished', {'kind': kind, 'imported': summary['imported']})
+        return jsonify(summary), 200
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Could not read file: {e}'}), 400
+    except Exception as e:
+        print(f"Import error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/export/<entity>', methods=['GET'])
+@route_class('background')
+@token_required
+def export_data(entity):
+    fmt = request.args.get('format', 'csv')
+    start = request.args.get('start')
+    end = request.args.get('end')
+    with_patients = request.args.get('withPatients') == '1'
+    compress = request.args.get('gzip') == '1'
+    for value in (start, end):
+        if value:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': 'start and end must be YYYY-MM-DD dates'}), 400
+
+    try:
+        conn = get_db_connection()
+        try:
+            chunks = iter_export(conn, entity, fmt, start, end, with_patients, compress)
+        except ValueError as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 400
+        # Rows are fetched and encoded while the response is written, never all at once
+        # A gzip export is a .gz download, not a transfer encoding the browser would undo
+        mimetype = 'application/gzip' if compress else FORMATS[fmt][0]
+        response = Response(stream_with_context(chunks), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={export_filename(entity, fmt, start, end, compress)}'
+        return response
+    except Exception as e:
+        print(f"Export error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/archive', methods=['POST'])
+@route_class('admin')
+@token_required
+@admin_required
+def archive_old_data():
+    data = request.get_json(silent=True) or {}
+    try:
+        max_age_days = int(data.get('maxAgeDays', ARCHIVE_AFTER_DAYS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'maxAgeDays must be a number'}), 400
+    if max_age_days < 1:
+        return jsonify({'error': 'maxAgeDays must be at least 1'}), 400
+    try:
+        conn = get_db_connection()
+        try:
+            result = run_archive(conn, max_age_days)
+        finally:
+            conn.close()
+        get_broker().refresh()
+        return jsonify(result), 200
+    except Exception as e:
+        print(f"Archive error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/sync', methods=['GET'])
+@route_class('background')
+@token_required
+def sync_changes():
+    try:
+        since = parse_cursor(request.args.get('since'))
+    except ValueError:
+        return jsonify({'error': 'Invalid sync cursor'}), 400
+    try:
+        # Always the primary; see changes_since
+        conn = get_db_connection(read_only=False)
+        try:
+            db_cursor = conn.cursor(dictionary=True)
+            result = changes_since(db_cursor, since)
+        finally:
+            conn.close()
+        return jsonify(result), 200
+    except Exception as e:
+        print(f"Sync error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/purge-jobs', methods=['GET'])
+@route_class('admin')
+@token_required
+@admin_required
+def get_purge_jobs():
+    try:
+        conn = get_db_connection(read_only=False)
+        db_cursor = conn.cursor(dictionary=True)
+        jobs = list_purge_jobs(db_cursor)
+        conn.close()
+        return jsonify([{
+            'id': job['id'],
+            'patientId': job['patient_id'],
+            'status': job['status'],
+            'currentTable': job['current_table'],
+            'rowsTotal': job['rows_total'],
+            'rowsPurged': job['rows_purged'],
+            'error': job['error'],
+            'createdAt': job['created_at'],
+            'startedAt': job['started_at'],
+            'finishedAt': job['finished_at']
+        } for job in jobs]), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/db-status', methods=['GET'])
+@route_class('admin')
+@token_required
+@admin_required
+def get_db_status():
+    return jsonify({
+        'replicas': replica_status(),
+        'singleFlight': flights.stats(),
+        'reportViews': view_stats(),
+        'queryCache': query_cache_stats(),
+        'admission': admission_stats(),
+        'connections': pool_status()
+    }), 200
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@route_class('admin')
+@token_required
+@admin_required
+def get_profiles():
+    return jsonify(list_profiles()), 200
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@route_class('admin')
+@token_required
+@admin_required
+def get_profile_stats(profile_id):
+    path = profile_path(profile_id)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    # ?format=top summarises in JSON; otherwise download the pstats file
+    if request.args.get('format') == 'top':
+        return jsonify(top_functions(profile_id, request.args.get('limit', default=25, type=int))), 200
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{profile_id}.prof')
+
+@app.route('/api/events/stream', methods=['GET'])
+@route_class(None)
+def event_stream():
+    # EventSource can't set an Authorization header, so the token comes in the query string
+    token = request.args.get('token')
+    if not token:
+        return jsonify({'error': 'Token is missing'}), 401
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        return jsonify({'error': 'Token has expired'}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({'error': 'Invalid token'}), 401
+    lab_id = token_lab_id(payload)
+    try:
+        shard_for_lab(lab_id)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 403
+
+    response = Response(stream_events(get_broker(lab_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop proxies from buffering the stream
+    return response
+
 @app.route('/api/current-date', methods=['GET'])
 @token_required
 def get_current_date():
@@ -0,0 +1,165 @@
+import gzip
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from flask import request
+from flask.json.provider import JSONProvider
+
+from rowmap import RowMapper
+
+try:
+    import orjson
+except ImportError:  # Falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Falls back to gzip
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv')
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, timedelta):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def encode_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONProvider(JSONProvider):
+    """JSON provider using orjson when installed, with ISO datetimes and Decimal support."""
+
+    def dumps(self, obj, **kwargs):
+        return encode_json(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Hand the encoded bytes straight to the response to skip a decode/encode round trip
+        return self._app.response_class(encode_json(obj), mimetype='application/json')
+
+
+def project_fields(data, fields=None):
+    """Keep only the comma-separated `fields` of a dict or of each dict in a list.
+
+    Lets list screens ask for just the columns they render, e.g.
+    GET /api/patients?fields=id,fullName,patientCode
+    """
+    if fields is None:
+        fields = request.args.get('fields')
+    if not fields:
+        return data
+    wanted = [field.strip() for field in fields.split(',') if field.strip()]
+    if isinstance(data, list):
+        return [{key: item[key] for key in wanted if key in item} for item in data]
+    if isinstance(data, dict):
+        return {key: data[key] for key in wanted if key in data}
+    return data
+
+
+def compress_body(body, accept_encodings):
+    """Return (body, encoding) compressed for the client, or encoding None if left as is."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if brotli is not None and accept_encodings['br'] > 0:
+        return brotli.compress(body, quality=5), 'br'
+    if accept_encodings['gzip'] > 0:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
+
+
+def compress_response(response):
+    """Compress larger text responses with brotli or gzip, whichever the client accepts."""
+    if (response.status_code < 200 or response.status_code >= 300
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    body, encoding = compress_body(response.get_data(), request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+PATIENT_ROW = RowMapper([
+    ('id', 'id'),
+    ('fullName', 'full_name'),
+    ('age', 'age'),
+    ('gender', 'gender'),
+    ('contactNumber', 'contact_number'),
+    ('email', 'email'),
+    ('patientCode', 'patient_code'),
+    ('address', 'address'),
+    ('refBy', 'ref_by', lambda value: value or ''),
+    ('createdAt', 'created_at'),
+])
+
+
+def group_test_categories(all_tests):
+    """Group test_catalog rows (as dicts) by category, then subcategory."""
+    result = {}
+    for test in all_tests:
+        category = test['category']
+        subcategory = test['subcategory']
+
+        if category not in result:
+            result[category] = {
+                'category': category,
+                'subcategories': []
+            }
+
+        # Find existing subcategory or create a new one
+        found_subcategory = None
+        for sub_item in result[category]['subcategories']:
+            if sub_item['subcategory'] == subcategory:
+                found_subcategory = sub_item
+                break
+
+        if not found_subcategory:
+            found_subcategory = {
+                'subcategory': subcategory,
+                'tests': []
+            }
+            result[category]['subcategories'].append(found_subcategory)
+
+        found_subcategory['tests'].append({
+            'id': test['id'],
+            'name': test['name'],
+            'referenceRange': test['reference_range'],
+            'unit': test['unit'],
+            'price': test['price']
+        })
+
+    # Sort subcategories and tests for consistent order
+    for category_data in result.values():
+        category_data['subcategories'].sort(key=lambda x: x['subcategory'])
+        for subcategory_data in category_data['subcategories']:
+            subcategory_data['tests'].sort(key=lambda x: x['name'])
+
+    return list(result.values())
+
+
+def init_serialization(app):
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
@@ -0,0 +1,73 @@
+import threading
+
+from database import current_shard_key, reading_replicas
+from profiling import profiling
+
+
+class _Call:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one computation per key at a time and hands its result to every concurrent caller.
+
+    Results are shared between requests, so callers must treat them as read-only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}
+
+    def do(self, key, loader):
+        name = key[0]
+        with self._lock:
+            stats = self._stats.setdefault(name, {'executed': 0, 'coalesced': 0})
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                stats['executed'] += 1
+            else:
+                stats['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = loader()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._stats.items()}
+
+
+flights = SingleFlight()
+
+
+def shared(name, args, loader):
+    """Run loader once for all concurrent requests with the same name and args in this lab.
+
+    Requests pinned to the primary after a write skip coalescing: a flight
+    that started before their write could hand them data without it. So do
+    profiled requests, which must run the loader themselves to measure it.
+    """
+    if not reading_replicas() or profiling():
+        return loader()
+    return flights.do((name, current_shard_key(), *args), loader)
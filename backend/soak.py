@@ -0,0 +1,261 @@
+"""Soak test: replay a mixed workload for a long time and fail if resources keep growing.
+
+Runs the Flask app in this process against the database configured in .env
+(use a local, disposable MySQL), so its memory can be watched directly:
+
+    python soak.py --minutes 240 --workers 8
+
+Workers replay a weighted mix of reads, writes and error paths: 404s, bad
+tokens, bad input, duplicate patient codes, streamed exports and
+register/report/delete cycles. Every --sample-seconds the harness records:
+
+    connections  Threads_connected on the server, minus the harness's own
+    rssMb        resident memory of this process
+    objects      live Python objects after a full collection
+
+After the warm-up samples, a metric that rose at every one of the last
+--window samples, and by more than its tolerance overall, fails the run
+(exit status 1). The object types that grew most are printed either way.
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import httpx
+import mysql.connector
+from werkzeug.serving import make_server
+
+from database import pool_status, primary_config
+from run import app
+
+# metric -> (absolute tolerance, relative tolerance); growth must exceed both
+TOLERANCES = {
+    'connections': (2, 0.0),
+    'rssMb': (16, 0.05),
+    'objects': (5000, 0.05),
+}
+MISSING_ID = 2_000_000_000
+
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def threads_connected(conn):
+    db_cursor = conn.cursor()
+    db_cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_connected'")
+    value = int(db_cursor.fetchone()[1])
+    db_cursor.close()
+    return value - 1  # Not counting this connection
+
+
+def object_types():
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def take_sample(monitor):
+    gc.collect()
+    return {
+        'connections': threads_connected(monitor),
+        'rssMb': round(rss_mb(), 1),
+        'objects': len(gc.get_objects()),
+    }
+
+
+def growing(series, window, tolerance):
+    """True when each of the last window steps rose and the total rise beats the tolerance."""
+    if len(series) <= window:
+        return False
+    recent = series[-(window + 1):]
+    absolute, relative = tolerance
+    rise = recent[-1] - recent[0]
+    return (all(later > earlier for earlier, later in zip(recent, recent[1:]))
+            and rise > absolute and rise > relative * recent[0])
+
+
+class Workload:
+    def __init__(self, client, email, password):
+        self.client = client
+        self.email = email
+        self.password = password
+        self.token = None
+        self.patient_ids = []
+        self.lock = threading.Lock()
+        self.results = Counter()
+
+    def login(self):
+        response = self.client.post('/api/login', json={'email': self.email, 'password': self.password})
+        response.raise_for_status()
+        self.token = response.json()['token']
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def some_patient(self):
+        with self.lock:
+            return random.choice(self.patient_ids) if self.patient_ids else MISSING_ID
+
+    def patient_body(self, code=None):
+        body = {
+            'fullName': 'Soak Test', 'age': 40, 'gender': 'Other', 'contactNumber': '0000000000',
+            'email': 'soak@example.com', 'address': 'Soak', 'refBy': '',
+        }
+        if code:
+            body['patientCode'] = code
+        return body
+
+    # Each action returns the response, or None when it made several requests itself
+    def register_cycle(self):
+        body = self.patient_body()
+        body.update(category='Soak', subcategory='Soak', tests=[
+            {'testName': f'Soak {n}', 'value': str(random.randint(1, 9)), 'normalRange': '2-8', 'unit': 'u'}
+            for n in range(5)
+        ])
+        response = self.client.post('/api/patients/register', json=body, headers=self.headers())
+        self.count('register', response)
+        if response.status_code != 201:
+            return None
+        patient_id = response.json()['patient']['id']
+        self.count('report', self.client.get(f'/api/reports/{patient_id}', headers=self.headers()))
+        with self.lock:
+            self.patient_ids.append(patient_id)
+            # Keep the data set bounded: delete the oldest soak patient
+            expired = self.patient_ids.pop(0) if len(self.patient_ids) > 50 else None
+        if expired is not None:
+            self.count('delete', self.client.delete(f'/api/patients/{expired}', headers=self.headers()))
+        return None
+
+    def duplicate_code(self):
+        code = f'SOAK-{uuid.uuid4().hex[:12]}'
+        for _ in range(2):  # The second insert hits the unique key
+            response = self.client.post('/api/patients', json=self.patient_body(code), headers=self.headers())
+            self.count('duplicate-code', response)
+        return None
+
+    def export(self):
+        with self.client.stream('GET', '/api/export/patients?format=csv', headers=self.headers()) as response:
+            for _ in response.iter_bytes():
+                pass
+        return response
+
+    def actions(self):
+        get = lambda path: lambda: self.client.get(path, headers=self.headers())
+        return [
+            (10, 'patients', get('/api/patients')),
+            (10, 'report', lambda: self.client.get(f'/api/reports/{self.some_patient()}', headers=self.headers())),
+            (4, 'report-404', get(f'/api/reports/{MISSING_ID}')),
+            (4, 'update-404', lambda: self.client.put(f'/api/patients/{MISSING_ID}', json=self.patient_body('SOAK-X'),
+                                                      headers=self.headers())),
+            (4, 'delete-result-404', lambda: self.client.delete(f'/api/test-results/{MISSING_ID}', headers=self.headers())),
+            (4, 'results-missing-patient', lambda: self.client.post('/api/test-results', headers=self.headers(), json={
+                'patientId': MISSING_ID, 'category': 'Soak', 'subcategory': 'Soak', 'tests': []})),
+            (5, 'count', get('/api/reports/count')),
+            (5, 'lab-info', get('/api/lab-info')),
+            (5, 'categories', get('/api/tests/categories')),
+            (3, 'profile', get('/api/profile')),
+            (3, 'sync-bad-cursor', get('/api/sync?since=not-a-cursor')),
+            (3, 'bad-token', lambda: self.client.get('/api/patients', headers={'Authorization': 'Bearer nope'})),
+            (2, 'bad-login', lambda: self.client.post('/api/login', json={'email': self.email, 'password': 'wrong'})),
+            (4, 'register-cycle', self.register_cycle),
+            (2, 'duplicate-code', self.duplicate_code),
+            (1, 'export', self.export),
+        ]
+
+    def count(self, name, response):
+        with self.lock:
+            self.results[(name, response.status_code)] += 1
+
+    def run(self, stop):
+        actions = self.actions()
+        weights = [weight for weight, _, _ in actions]
+        while not stop.is_set():
+            _, name, action = random.choices(actions, weights)[0]
+            try:
+                response = action()
+            except httpx.HTTPError as e:
+                with self.lock:
+                    self.results[(name, type(e).__name__)] += 1
+                continue
+            if response is not None:
+                self.count(name, response)
+                if response.status_code == 401 and name not in ('bad-token', 'bad-login'):
+                    self.login()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=60)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--sample-seconds', type=float, default=60)
+    parser.add_argument('--warmup-samples', type=int, default=3)
+    parser.add_argument('--window', type=int, default=8)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--email', default=os.getenv('ADMIN_EMAIL', 'admin@labassist.com'))
+    parser.add_argument('--password', default=os.getenv('ADMIN_PASSWORD', 'labassist@admin123'))
+    args = parser.parse_args()
+
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='soak-server', daemon=True).start()
+
+    stop = threading.Event()
+    client = httpx.Client(base_url=f'http://127.0.0.1:{args.port}', timeout=60)
+    workload = Workload(client, args.email, args.password)
+    workload.login()
+    workers = [threading.Thread(target=workload.run, args=(stop,), daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    monitor = mysql.connector.connect(**primary_config())
+    monitor.autocommit = True
+    samples = []
+    baseline_types = None
+    failures = []
+    deadline = time.monotonic() + args.minutes * 60
+    try:
+        while time.monotonic() < deadline and not failures:
+            time.sleep(args.sample_seconds)
+            sample = take_sample(monitor)
+            sample['leakedClosed'] = pool_status()['leakedConnectionsClosed']
+            samples.append(sample)
+            if len(samples) == args.warmup_samples:
+                baseline_types = object_types()
+            print(f"[{len(samples):4}] " + '  '.join(f'{key} {value}' for key, value in sample.items()), flush=True)
+            if len(samples) <= args.warmup_samples:
+                continue
+            measured = samples[args.warmup_samples - 1:]
+            failures = [
+                metric for metric, tolerance in TOLERANCES.items()
+                if growing([s[metric] for s in measured], args.window, tolerance)
+            ]
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=30)
+        server.shutdown()
+        monitor.close()
+
+    print('\nRequests by action and status:')
+    for (name, status), count in sorted(workload.results.items(), key=lambda item: str(item[0])):
+        print(f'  {name:>24} {status!s:>16} {count:8}')
+    if baseline_types is not None:
+        print('\nObject types that grew most since warm-up:')
+        for name, grown in (object_types() - baseline_types).most_common(10):
+            print(f'  {name:>32} +{grown}')
+    if failures:
+        print(f"\nFAIL: monotonic growth in {', '.join(failures)}")
+        sys.exit(1)
+    print(f'\nOK: no monotonic growth over {len(samples)} samples')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Delta sync: rows created, updated or deleted since a client's cursor.
+
+Clients keep a local copy of the synced tables and call
+
+    GET /api/sync?since=<cursor>
+
+with the cursor from their previous response (or none for a full snapshot).
+Changed rows come from the updated_at column each synced table carries, and
+deletes from sync_tombstones, which the delete endpoints write to. Clients
+apply the changed rows first, then the deletes.
+"""
+import os
+from datetime import datetime, timedelta
+
+from purge import DELETED_PATIENT_IDS
+from results import ARCHIVED_RESULT_LISTING, RESULT_LISTING
+from serialization import PATIENT_ROW
+
+# The next cursor trails the database clock by this much, so rows from
+# transactions that committed late with an earlier updated_at are sent again
+# rather than missed. Clients apply rows as upserts, so repeats are harmless.
+SYNC_OVERLAP_SECONDS = 5
+# Tombstones are pruned after this many days; older cursors get a full snapshot
+SYNC_TOMBSTONE_DAYS = int(os.getenv('SYNC_TOMBSTONE_DAYS', '30'))
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Response key -> table, the query for its rows (aliased t), how rows are
+# shaped (None sends columns as is), the filter for rows clients should have
+# and the query for the table's archived rows, if archive.py moves any
+SYNCED_TABLES = {
+    'patients': ('patients', 'SELECT t.* FROM patients t', PATIENT_ROW.map_dicts, 't.deleted_at IS NULL', None),
+    'results': ('tests', RESULT_LISTING, None, f't.patient_id NOT IN ({DELETED_PATIENT_IDS})',
+                ARCHIVED_RESULT_LISTING),
+    'refDoctors': ('ref_doctors', 'SELECT t.* FROM ref_doctors t', None, '1 = 1', None),
+    'testCatalog': ('test_catalog', 'SELECT t.* FROM test_catalog t', None, '1 = 1', None),
+}
+
+
+def parse_cursor(value):
+    """Return the datetime in a sync cursor, or None for a full snapshot. Raises ValueError."""
+    if not value:
+        return None
+    return datetime.strptime(value, CURSOR_FORMAT)
+
+
+def record_deletes(db_cursor, table, ids):
+    """Leave tombstones for rows of table that are being deleted, in the caller's transaction."""
+    if ids:
+        db_cursor.executemany(
+            'INSERT INTO sync_tombstones (table_name, row_id) VALUES (%s, %s)',
+            [(table, row_id) for row_id in ids]
+        )
+
+
+def prune_tombstones(conn):
+    db_cursor = conn.cursor()
+    db_cursor.execute(
+        'DELETE FROM sync_tombstones WHERE deleted_at < NOW(6) - INTERVAL %s DAY',
+        (SYNC_TOMBSTONE_DAYS,)
+    )
+    pruned = db_cursor.rowcount
+    conn.commit()
+    return pruned
+
+
+def changes_since(db_cursor, since):
+    """Collect changed rows and deleted ids per synced table; db_cursor must return dicts.
+
+    Run it against the primary: a lagging replica's clock is ahead of its
+    data, so its cursor would skip rows it hasn't applied yet.
+    """
+    db_cursor.execute('SELECT NOW(6) AS now')
+    now = db_cursor.fetchone()['now']
+    full = since is None or since < now - timedelta(days=SYNC_TOMBSTONE_DAYS)
+
+    changes = {}
+    deleted = {}
+    for key, (table, query, shape, live_condition, archive_query) in SYNCED_TABLES.items():
+        if full and archive_query:
+            # A snapshot must include archived rows. Deltas don't need them: archived
+            # rows never change, and the archiver leaves no tombstones for them
+            db_cursor.execute(f'{query} WHERE {live_condition} UNION ALL {archive_query} WHERE {live_condition}')
+        elif full:
+            db_cursor.execute(f'{query} WHERE {live_condition}')
+        else:
+            db_cursor.execute(f'{query} WHERE t.updated_at > %s AND {live_condition}', (since,))
+        rows = db_cursor.fetchall()
+        changes[key] = shape(rows) if shape else rows
+
+        if not full:
+            db_cursor.execute(
+                'SELECT DISTINCT row_id FROM sync_tombstones WHERE table_name = %s AND deleted_at > %s',
+                (table, since)
+            )
+            deleted[key] = [row['row_id'] for row in db_cursor.fetchall()]
+        else:
+            deleted[key] = []
+
+    return {
+        'cursor': (now - timedelta(seconds=SYNC_OVERLAP_SECONDS)).strftime(CURSOR_FORMAT),
+        # A full snapshot replaces the client's store instead of patching it
+        'full': full,
+        'changes': changes,
+        'deleted': deleted,
+    }
@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import { patientService, testService, reportService } from '../services/api';
+import { patientService, testService, reportService, eventService } from '../services/api';
 
 function formatDateDMY(dateString) {
     const d = new Date(dateString);
@@ -145,8 +145,54 @@ const Dashboard = () => {
         };
 
         fetchStats();
-        const intervalId = setInterval(fetchStats, 30000); // Refresh every 30 seconds
-        return () => clearInterval(intervalId);
+
+        // Live updates: counters and new activity are pushed by the server instead of polled
+        const events = eventService.open();
+        const addActivity = (activity) => {
+            setRecentActivity(prev => [activity, ...prev].slice(0, 5));
+        };
+        const onEvent = (handler) => (e) => {
+            const data = JSON.parse(e.data);
+            if (data.counters) {
+                setStats(data.counters);
+            }
+            if (handler) handler(data);
+        };
+        const now = () => new Date().toISOString();
+
+        events.addEventListener('counters', onEvent());
+        events.addEventListener('patient-deleted', onEvent());
+        events.addEventListener('result-deleted', onEvent());
+        events.addEventListener('batch-registered', onEvent(() => fetchStats()));
+        events.addEventListener('import-finished', onEvent(() => fetchStats()));
+        // Sent with fresh counters when writes handled by another server worker are noticed
+        events.addEventListener('changed', onEvent());
+        events.addEventListener('new-patient', onEvent(data => addActivity({
+            type: 'patient',
+            title: 'New Patient Registration',
+            description: `${data.fullName} registered as a new patient`,
+            time: formatDateDMY(now()),
+            rawDate: now(),
+            icon: <span className="material-icons text-blue-500">person_add</span>
+        })));
+        events.addEventListener('new-result', onEvent(data => addActivity({
+            type: 'test',
+            title: 'Test Completed',
+            description: `${data.tests.join(', ')} results are ready`,
+            time: formatDateDMY(data.testDate || now()),
+            rawDate: data.testDate || now(),
+            icon: <span className="material-icons text-green-500">science</span>
+        })));
+        events.addEventListener('new-report', onEvent(() => addActivity({
+            type: 'report',
+            title: 'Report Generated',
+            description: 'A patient report was generated',
+            time: formatDateDMY(now()),
+            rawDate: now(),
+            icon: <span className="material-icons text-indigo-500">description</span>
+        })));
+
+        return () => events.close();
     }, []);
 
     const statsCards = [
@@ -125,6 +125,22 @@ export const patientService = {
     } catch (error) {
       return { success: false, error: error.response?.data?.error || 'Failed to fetch latest patient code' };
     }
+  },
+  register: async (data) => {
+    try {
+      const response = await api.post('/patients/register', data);
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to register patient' };
+    }
+  },
+  batchRegister: async (patients) => {
+    try {
+      const response = await api.post('/patients/batch-register', { patients });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to register patients' };
+    }
   }
 };
 
@@ -355,4 +371,47 @@ export const securityService = {
   }
 };
 
+export const eventService = {
+  // EventSource can't send headers, so the token travels as a query parameter
+  open: () => new EventSource(`${API_URL}/events/stream?token=${encodeURIComponent(localStorage.getItem('token') || '')}`)
+};
+
+export const importService = {
+  upload: async (kind, file) => {
+    try {
+      const formData = new FormData();
+      formData.append('file', file);
+      const response = await api.post(`/import/${kind}`, formData, {
+        headers: { 'Content-Type': 'multipart/form-data' }
+      });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to import file' };
+    }
+  }
+};
+
+export const exportService = {
+  download: async (entity, params = {}) => {
+    try {
+      const response = await api.get(`/export/${entity}`, { params, responseType: 'blob' });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to export data' };
+    }
+  }
+};
+
+export const syncService = {
+  // Pass the cursor from the previous response; omit it for a full snapshot
+  changes: async (since) => {
+    try {
+      const response = await api.get('/sync', { params: since ? { since } : {} });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { success: false, error: error.response?.data?.error || 'Failed to sync changes' };
+    }
+  }
+};
+
 export default api;
\ No newline at end of file